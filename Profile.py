@@ -4,10 +4,13 @@
 """Module for handling user profiles in the messaging system.
 Provides classes for profile stuff, posts, and direct messaging."""
 
-import json
+import os
+import sys
 import time
 from pathlib import Path
 
+import jsonutil
+
 
 class DsuFileError(Exception):
     """Exception raised for errors related to DSU files."""
@@ -17,9 +20,59 @@ class DsuProfileError(Exception):
     """Exception raised for errors related to DSU profiles."""
 
 
-class Post(dict):
+def _write_json_array(f, items) -> None:
+    """Write items to a binary file as a JSON array, one at a time.
+
+    Args:
+        f: The binary file object to write to
+        items: An iterable of JSON-serializable items
+    """
+    f.write(b'[')
+    for i, item in enumerate(items):
+        if i:
+            f.write(b',')
+        f.write(jsonutil.dumps(item))
+    f.write(b']')
+
+
+def _start_log(path: str, gen: int) -> None:
+    """Atomically replace the append log with an empty one for a snapshot
+    generation.
+
+    Args:
+        path: The log file path
+        gen: The generation of the snapshot the log extends
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(jsonutil.dumps({'type': 'gen', 'gen': gen}) + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _message_key(message) -> tuple:
+    """Build the key used to detect duplicate direct messages.
+
+    Args:
+        message: The DirectMessage to build a key for
+
+    Returns:
+        A (timestamp, sender, content) tuple
+    """
+    return (message.timestamp, message.from_user, message.message)
+
+
+# appended posts/messages are compacted into the .dsu snapshot after
+# this many log writes
+COMPACT_EVERY = 100
+
+
+class Post:
     """Represents a post in a user's profile."""
 
+    __slots__ = ('entry', 'timestamp')
+
     def __init__(self, entry: str = None, timestamp: float = 0):
         """Initialize a new Post.
 
@@ -27,10 +80,8 @@ class Post(dict):
             entry: The content of the post
             timestamp: The time when the post was created
         """
-        self._timestamp = timestamp
-        self.set_entry(entry)
-        dict.__init__(self, entry=self._entry,
-                      timestamp=self._timestamp)
+        self.entry = entry
+        self.timestamp = timestamp or time.time()
 
     def set_entry(self, entry):
         """Set the content of the post.
@@ -38,10 +89,7 @@ class Post(dict):
         Args:
             entry: The content to set
         """
-        self._entry = entry
-        dict.__setitem__(self, 'entry', entry)
-        if self._timestamp == 0:
-            self._timestamp = time.time()
+        self.entry = entry
 
     def get_entry(self):
         """Get the content of the post.
@@ -49,7 +97,7 @@ class Post(dict):
         Returns:
             The post content
         """
-        return self._entry
+        return self.entry
 
     def set_time(self, timestamp: float):
         """Set the timestamp of the post.
@@ -57,8 +105,7 @@ class Post(dict):
         Args:
             timestamp: The time to set
         """
-        self._timestamp = timestamp
-        dict.__setitem__(self, 'timestamp', timestamp)
+        self.timestamp = timestamp
 
     def get_time(self):
         """Get the timestamp of the post.
@@ -66,15 +113,50 @@ class Post(dict):
         Returns:
             The post timestamp
         """
-        return self._timestamp
+        return self.timestamp
+
+    def to_dict(self):
+        """Convert to dictionary for JSON serialization.
+
+        Returns:
+            Dictionary representation of the post
+        """
+        return {'entry': self.entry, 'timestamp': self.timestamp}
 
-    entry = property(get_entry, set_entry)
-    timestamp = property(get_time, set_time)
+
+def _intern(value):
+    """Intern usernames so messages between the same users share them.
+
+    Args:
+        value: The username (or None)
+
+    Returns:
+        The interned string, or value unchanged if it isn't a string
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+# free list of released DirectMessage instances, see DirectMessage.acquire
+_DM_POOL = []
+_DM_POOL_MAX = 1024
 
 
 class DirectMessage:
     """Represents a direct message between users."""
 
+    __slots__ = ('message', 'recipient', 'timestamp',
+                 'from_user', 'entry')
+
+    # dict-style keys accepted by get() -> attribute
+    _KEY_MAP = {
+        'message': 'message',
+        'recipient': 'recipient',
+        'timestamp': 'timestamp',
+        'from': 'from_user',
+        'from_user': 'from_user',
+        'entry': 'entry',
+    }
+
     def __init__(self, message=None, recipient=None,
                  timestamp=None, from_user=None):
         """Initialize a new DirectMessage.
@@ -88,18 +170,44 @@ class DirectMessage:
         #  message is a dictionary, extract values from it
         if isinstance(message, dict):
             data = message
-            self._message = data.get('message')
-            self._recipient = data.get('recipient')
-            self._timestamp = data.get('timestamp') or time.time()
-            self._from_user = data.get('from_user')
-            self._entry = self._message  # For compatibility
+            self.message = data.get('message')
+            self.recipient = _intern(data.get('recipient'))
+            self.timestamp = data.get('timestamp') or time.time()
+            self.from_user = _intern(data.get('from_user'))
+            self.entry = self.message  # For compatibility
         else:
             # a normal init but with separate arguments
-            self._message = message
-            self._recipient = recipient
-            self._timestamp = timestamp or time.time()
-            self._from_user = from_user
-            self._entry = message  # For compatibility
+            self.message = message
+            self.recipient = _intern(recipient)
+            self.timestamp = timestamp or time.time()
+            self.from_user = _intern(from_user)
+            self.entry = message  # For compatibility
+
+    @classmethod
+    def acquire(cls, message=None, recipient=None,
+                timestamp=None, from_user=None):
+        """Get a DirectMessage, reusing a released instance if possible.
+
+        Takes the same arguments as the constructor.
+
+        Returns:
+            An initialized DirectMessage
+        """
+        if _DM_POOL:
+            dm = _DM_POOL.pop()
+            dm.__init__(message, recipient, timestamp, from_user)
+            return dm
+        return cls(message, recipient, timestamp, from_user)
+
+    def release(self) -> None:
+        """Clear the message and return it to the pool for reuse.
+
+        The caller must not use the message after releasing it.
+        """
+        self.message = self.recipient = self.timestamp = None
+        self.from_user = self.entry = None
+        if len(_DM_POOL) < _DM_POOL_MAX:
+            _DM_POOL.append(self)
 
     def get_entry(self):
         """Get the message content (alias for compatibility).
@@ -107,7 +215,7 @@ class DirectMessage:
         Returns:
             The message content
         """
-        return self._message
+        return self.message
 
     def get_message(self):
         """Get the message content.
@@ -115,7 +223,7 @@ class DirectMessage:
         Returns:
             The message content
         """
-        return self._message
+        return self.message
 
     def get_recipient(self):
         """Get the recipient username.
@@ -123,7 +231,7 @@ class DirectMessage:
         Returns:
             The recipient's username
         """
-        return self._recipient
+        return self.recipient
 
     def get_timestamp(self):
         """Get the message timestamp.
@@ -131,7 +239,7 @@ class DirectMessage:
         Returns:
             The message timestamp
         """
-        return self._timestamp
+        return self.timestamp
 
     def get_from_user(self):
         """Get the sender username.
@@ -139,7 +247,7 @@ class DirectMessage:
         Returns:
             The sender's username
         """
-        return self._from_user
+        return self.from_user
 
     def to_dict(self):
         """Convert to dictionary for JSON serialization.
@@ -148,16 +256,15 @@ class DirectMessage:
             Dictionary representation of the message
         """
         return {
-            'message': self._message,
-            'recipient': self._recipient,
-            'timestamp': self._timestamp,
-            'from_user': self._from_user,
-            'entry': self._entry
+            'message': self.message,
+            'recipient': self.recipient,
+            'timestamp': self.timestamp,
+            'from_user': self.from_user,
+            'entry': self.entry
         }
 
     # add a get method for dictionary access
     def get(self, key, default=None):
-        # pylint: disable=too-many-return-statements
         """Dict-like get method for compatibility.
 
         Args:
@@ -167,25 +274,8 @@ class DirectMessage:
         Returns:
             The value associated with the key or the default
         """
-        if key == 'message':
-            return self._message
-        if key == 'recipient':
-            return self._recipient
-        if key == 'timestamp':
-            return self._timestamp
-        if key == 'from':
-            return self._from_user
-        if key == 'from_user':
-            return self._from_user
-        if key == 'entry':
-            return self._entry
-        return default
-
-    entry = property(get_entry)
-    message = property(get_message)
-    recipient = property(get_recipient)
-    timestamp = property(get_timestamp)
-    from_user = property(get_from_user)
+        attr = self._KEY_MAP.get(key)
+        return getattr(self, attr) if attr else default
 
 
 class Profile:
@@ -205,8 +295,13 @@ class Profile:
         self.password = password    # REQUIRED
         self.bio = ''              # OPTIONAL
         self._posts = []           # OPTIONAL
-        self._messages = []        # Added for direct messaging
+        self._messages = {}        # dedupe key -> message, in arrival order
         self._friends = set()      # Added to store recipients/friends
+        self._by_peer = {}         # peer username -> messages with them
+        self._path = None          # .dsu snapshot this profile syncs to
+        self._log_path = None      # append-only log next to the snapshot
+        self._dirty = 0            # log writes since the last snapshot
+        self._log_gen = 0          # snapshot generation the log extends
 
     def add_post(self, post: Post) -> None:
         """Add a post to the profile.
@@ -216,6 +311,90 @@ class Profile:
         """
         self._posts.append(post)
 
+    def append_post(self, post: Post) -> None:
+        """Add a post and record it in the profile's append log.
+
+        Args:
+            post: The Post object to add
+        """
+        self.add_post(post)
+        self._append_log({'type': 'post', **post.to_dict()})
+
+    def append_message(self, message) -> None:
+        """Add a direct message and record it in the profile's append log.
+
+        Args:
+            message: The DirectMessage object or dict to add
+        """
+        if isinstance(message, dict):
+            message = DirectMessage(message)
+        if self.add_direct_message(message):
+            self._append_log({'type': 'message', **message.to_dict()})
+
+    def _append_log(self, record: dict) -> None:
+        """Durably append one record to the log, compacting when due.
+
+        Records are only logged once the profile has been saved to or
+        loaded from a DSU file; until then save_profile() writes them.
+
+        Args:
+            record: The JSON-serializable record to append
+
+        Raises:
+            DsuFileError: If there's an error writing the log
+        """
+        if not self._log_path:
+            return
+
+        try:
+            with open(self._log_path, 'ab') as f:
+                f.write(jsonutil.dumps(record) + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as ex:
+            raise DsuFileError("Error while attempting to "
+                               "write the DSU log.", ex) from ex
+
+        self._dirty += 1
+        if self._dirty >= COMPACT_EVERY:
+            self.save_profile(self._path)
+
+    def _replay_log(self) -> None:
+        """Apply records from the append log on top of the snapshot."""
+        try:
+            with open(self._log_path, 'rb') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return
+
+        # a log starts with the snapshot generation it extends (logs
+        # from before generations were recorded don't, and count as 0)
+        log_gen = 0
+        if lines:
+            try:
+                first = jsonutil.loads(lines[0])
+            except ValueError:
+                first = None
+            if isinstance(first, dict) and first.get('type') == 'gen':
+                log_gen = first.get('gen', 0)
+                lines = lines[1:]
+        if log_gen != self._log_gen:
+            # left over from before the snapshot was replaced: everything
+            # in it is already in the snapshot
+            return
+
+        for line in lines:
+            try:
+                record = jsonutil.loads(line)
+            except ValueError:
+                break  # torn write at the tail of the log
+            if record.get('type') == 'post':
+                self.add_post(Post(record.get('entry'),
+                                   record.get('timestamp')))
+            elif record.get('type') == 'message':
+                self.add_direct_message(DirectMessage.acquire(record))
+            self._dirty += 1
+
     def del_post(self, index: int) -> bool:
         """Delete a post from the profile.
 
@@ -239,24 +418,42 @@ class Profile:
         """
         return self._posts
 
-    def add_direct_message(self, message):
+    def add_direct_message(self, message) -> bool:
         """
         Add a direct message to the profile with improved handling.
         
         Args:
             message: The DirectMessage object or dict to add
+
+        Returns:
+            True if the message was added, False if it was a duplicate
         """
         if isinstance(message, dict):
             message = DirectMessage(message)
-        
-        # add message to our collection
-        self._messages.append(message)
+
+        # add message to our collection, skipping ones we already have
+        key = _message_key(message)
+        if key in self._messages:
+            return False
+        self._messages[key] = message
+        self._index_message(message)
         
         # update friends list with both sender and recipient
-        if message.get_recipient() and message.get_recipient() != self.username:
-            self._friends.add(message.get_recipient())
-        if message.get_from_user() and message.get_from_user() != self.username:
-            self._friends.add(message.get_from_user())
+        if message.recipient and message.recipient != self.username:
+            self._friends.add(message.recipient)
+        if message.from_user and message.from_user != self.username:
+            self._friends.add(message.from_user)
+        return True
+
+    def _index_message(self, message) -> None:
+        """Index a message under each user it was exchanged with.
+
+        Args:
+            message: The DirectMessage object to index
+        """
+        for peer in {message.recipient, message.from_user}:
+            if peer:
+                self._by_peer.setdefault(peer, []).append(message)
 
     def get_direct_messages(self) -> list[DirectMessage]:
         """Get all direct messages.
@@ -264,7 +461,7 @@ class Profile:
         Returns:
             List of DirectMessage objects
         """
-        return self._messages
+        return list(self._messages.values())
 
     def get_messages_with(self, username: str) -> list[DirectMessage]:
         """Get all messages exchanged with a specific user.
@@ -275,10 +472,7 @@ class Profile:
         Returns:
             List of DirectMessage objects exchanged with the specified user
         """
-        return [
-            msg for msg in self._messages
-            if username in (msg.recipient, msg.from_user)
-        ]
+        return list(self._by_peer.get(username, ()))
 
     def get_friends(self) -> list:
         """Get list of friends/recipients.
@@ -309,21 +503,56 @@ class Profile:
         p = Path(path)
 
         if p.suffix == '.dsu':
+            tmp = p.with_suffix('.dsu.tmp')
+            replaced = False
             try:
-                data = {
+                header = jsonutil.dumps({
                     'username': self.username,
                     'password': self.password,
                     'dsuserver': self.dsuserver,
                     'bio': self.bio,
-                    '_posts': self._posts,
-                    '_messages':
-                    [msg.to_dict() for msg in self._messages],
-                    '_friends': list(self._friends)
-                }
-
-                with open(p, 'w', encoding='utf-8') as f:
-                    json.dump(data, f)
+                    '_log_gen': self._log_gen + 1
+                })
+
+                # stream posts and messages one record at a time rather
+                # than building the whole document in memory first. it
+                # goes to a temporary file that replaces the snapshot only
+                # once it is safely on disk, so a crash part way through
+                # leaves the old snapshot and the log intact
+                with open(tmp, 'wb') as f:
+                    f.write(header[:-1])  # leave the object open
+                    f.write(b',"_posts":')
+                    _write_json_array(f, (post.to_dict()
+                                          for post in self._posts))
+                    f.write(b',"_messages":')
+                    messages = self._messages.values()
+                    _write_json_array(f, (msg.to_dict() for msg in messages))
+                    f.write(b',"_friends":')
+                    _write_json_array(f, self._friends)
+                    f.write(b'}')
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, p)
+                replaced = True
+
+                # the snapshot now holds everything, so start a fresh log
+                # for the new generation. until that is in place the old
+                # log is stale, and load_profile skips it by its older
+                # generation instead of replaying records twice
+                self._path = str(p)
+                self._log_path = self._path + '.log'
+                self._log_gen += 1
+                _start_log(self._log_path, self._log_gen)
+                self._dirty = 0
             except Exception as ex:
+                if replaced:
+                    # don't append to a log the snapshot would ignore;
+                    # new records wait in memory for the next save
+                    self._log_path = None
+                try:
+                    tmp.unlink()
+                except OSError:
+                    pass
                 raise DsuFileError("Error while attempting to "
                                    "process the DSU file.", ex) from ex
         else:
@@ -340,34 +569,51 @@ class Profile:
             DsuProfileError: If there's an error processing the profile data
         """
         p = Path(path)
+        if p.suffix != '.dsu':
+            raise DsuFileError()
 
-        if p.exists() and p.suffix == '.dsu':
-            try:
-                with open(p, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                self.username = data.get('username')
-                self.password = data.get('password')
-                self.dsuserver = data.get('dsuserver')
-                self.bio = data.get('bio', '')
-
-                # load the posts
-                self._posts = []
-                for post_data in data.get('_posts', []):
-                    post = Post(post_data.get('entry'),
-                                post_data.get('timestamp'))
-                    self._posts.append(post)
+        try:
+            with open(p, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            raise DsuFileError() from None
+        except OSError as ex:
+            raise DsuProfileError(ex) from ex
 
-                # load messages
-                self._messages = []
-                for msg_data in data.get('_messages', []):
-                    msg = DirectMessage(msg_data)
-                    self._messages.append(msg)
+        try:
+            data = jsonutil.loads(raw)
 
-                # load friends
-                self._friends = set(data.get('_friends', []))
+            self.username = data.get('username')
+            self.password = data.get('password')
+            self.dsuserver = data.get('dsuserver')
+            self.bio = data.get('bio', '')
 
-            except Exception as ex:
-                raise DsuProfileError(ex) from ex
-        else:
-            raise DsuFileError()
+            # load the posts
+            self._posts = [Post(post_data.get('entry'),
+                                post_data.get('timestamp'))
+                           for post_data in data.get('_posts', [])]
+
+            # load messages
+            self._messages = messages = {}
+            self._by_peer = {}
+            index_message = self._index_message
+            for msg in map(DirectMessage.acquire, data.get('_messages', [])):
+                key = _message_key(msg)
+                if key in messages:
+                    msg.release()
+                    continue
+                messages[key] = msg
+                index_message(msg)
+
+            # load friends
+            self._friends = set(data.get('_friends', []))
+
+            # replay anything appended since the snapshot
+            self._path = str(p)
+            self._log_path = self._path + '.log'
+            self._log_gen = data.get('_log_gen', 0)
+            self._dirty = 0
+            self._replay_log()
+
+        except Exception as ex:
+            raise DsuProfileError(ex) from ex
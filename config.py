@@ -4,18 +4,29 @@
 import json
 from pathlib import Path
 
+import jsonutil
+
 DEFAULT_CONFIG = {
     "server": "127.0.0.1",
     "port": 3001,
     "poll_interval": 2,
     "max_retries": 5,
     "db_path": "messenger.db",
+    # sqlite synchronous level: FULL (safest), NORMAL or OFF (fastest)
+    "sync_mode": "NORMAL",
+    # most unsent messages held in memory; beyond this they go straight
+    # to the pending table
+    "max_outgoing_queue": 1024,
     "log_file": "messenger.log"
 }
 
 
 class Config:
-    """manages application configuration."""
+    """manages application configuration.
+
+    the DEFAULT_CONFIG keys are also exposed as plain attributes
+    (config.server, config.poll_interval, ...) kept in sync by load/set.
+    """
 
     def __init__(self, config_path='config.json'):
         self.config_path = Path(config_path)
@@ -24,13 +35,18 @@ class Config:
 
     def load(self):
         """load config from file if it exists."""
-        if self.config_path.exists():
-            try:
-                with open(self.config_path, 'r', encoding='utf-8') as f:
-                    loaded = json.load(f)
-                    self.settings.update(loaded)
-            except (json.JSONDecodeError, IOError):
-                pass  # use defaults
+        try:
+            with open(self.config_path, 'rb') as f:
+                loaded = jsonutil.loads(f.read())
+                self.settings.update(loaded)
+        except (json.JSONDecodeError, IOError):
+            pass  # missing or unreadable - use defaults
+        self._sync_attributes()
+
+    def _sync_attributes(self):
+        """mirror known settings onto attributes for cheap access."""
+        for key in DEFAULT_CONFIG:
+            setattr(self, key, self.settings[key])
 
     def save(self):
         """save current config to file."""
@@ -47,28 +63,6 @@ class Config:
     def set(self, key, value):
         """set a config value."""
         self.settings[key] = value
+        if key in DEFAULT_CONFIG:
+            setattr(self, key, value)
         self.save()
-
-    @property
-    def server(self):
-        return self.settings['server']
-
-    @property
-    def port(self):
-        return self.settings['port']
-
-    @property
-    def poll_interval(self):
-        return self.settings['poll_interval']
-
-    @property
-    def max_retries(self):
-        return self.settings['max_retries']
-
-    @property
-    def db_path(self):
-        return self.settings['db_path']
-
-    @property
-    def log_file(self):
-        return self.settings['log_file']
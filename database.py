@@ -2,190 +2,388 @@
 """SQLite database module for persistent message storage."""
 
 import sqlite3
+import threading
 from contextlib import contextmanager
 from pathlib import Path
 
 from security import hash_password, verify_password
 
+# schema. timestamps are stored as INTEGER microseconds since the epoch,
+# see to_db_time()/from_db_time()
+_MESSAGES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        sender TEXT NOT NULL,
+        recipient TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        is_sent BOOLEAN DEFAULT 1,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+'''
+
+_PENDING_TABLE = '''
+    CREATE TABLE IF NOT EXISTS pending_messages (
+        pending_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        recipient TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        attempts INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+'''
+
+_SCHEMA_TABLES = '''
+    -- users table
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        server TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- contacts table
+    CREATE TABLE IF NOT EXISTS contacts (
+        contact_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        friend_username TEXT NOT NULL,
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(user_id),
+        UNIQUE(user_id, friend_username)
+    );
+
+    -- messages table
+''' + _MESSAGES_TABLE + '''
+    -- pending messages (offline queue)
+''' + _PENDING_TABLE
+
+_SCHEMA_INDEXES = '''
+    -- indexes for performance
+    DROP INDEX IF EXISTS idx_messages_user;
+    DROP INDEX IF EXISTS idx_messages_timestamp;
+    CREATE INDEX IF NOT EXISTS idx_messages_user_ts
+        ON messages(user_id, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_msgs_user_sender_ts
+        ON messages(user_id, sender, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_msgs_user_recipient_ts
+        ON messages(user_id, recipient, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_contacts_user ON contacts(user_id);
+    CREATE INDEX IF NOT EXISTS idx_pending_user_ts
+        ON pending_messages(user_id, timestamp);
+'''
+
+# tables whose timestamp column moved from REAL seconds to INTEGER
+# microseconds: (name, create statement, columns to copy)
+_TIMESTAMP_TABLES = (
+    ('messages', _MESSAGES_TABLE,
+     'message_id, user_id, sender, recipient, content, timestamp, is_sent'),
+    ('pending_messages', _PENDING_TABLE,
+     'pending_id, user_id, recipient, content, timestamp, attempts, '
+     'created_at'),
+)
+
+
+def to_db_time(seconds) -> int:
+    """convert a unix timestamp in seconds to stored microseconds."""
+    return int(round(float(seconds) * 1_000_000))
+
+
+def from_db_time(micros) -> float:
+    """convert stored microseconds back to a unix timestamp in seconds."""
+    return micros / 1_000_000
+
+
+# sql statements, kept at module scope so every call reuses the same
+# text and hits the connection's prepared-statement cache
+_SQL_GET_USER_AUTH = 'SELECT user_id, password_hash FROM users WHERE username = ?'
+_SQL_GET_USER = 'SELECT * FROM users WHERE username = ?'
+# creates the user, or upgrades a legacy plain text password to the new
+# hash, in a single statement (needs sqlite 3.35+ for RETURNING)
+_SQL_UPSERT_USER = '''
+    INSERT INTO users (username, password_hash, server) VALUES (?, ?, ?)
+    ON CONFLICT(username) DO UPDATE SET password_hash = CASE
+        WHEN users.password_hash = ? THEN excluded.password_hash
+        ELSE users.password_hash
+    END
+    RETURNING user_id
+'''
+_SQL_SET_HASH_BY_NAME = 'UPDATE users SET password_hash = ? WHERE username = ?'
+
+_SQL_ADD_CONTACT = 'INSERT OR IGNORE INTO contacts (user_id, friend_username) VALUES (?, ?)'
+_SQL_GET_CONTACTS = 'SELECT friend_username FROM contacts WHERE user_id = ? ORDER BY friend_username'
+_SQL_DEL_CONTACT = 'DELETE FROM contacts WHERE user_id = ? AND friend_username = ?'
+
+_SQL_ADD_MSG = '''
+    INSERT INTO messages (user_id, sender, recipient, content, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+'''
+_SQL_LAST_ID = 'SELECT last_insert_rowid()'
+# split into two index seeks instead of an OR that forces a scan
+_SQL_GET_MSGS_PEER = '''
+    SELECT * FROM messages
+    WHERE user_id = ? AND sender = ?
+    UNION ALL
+    SELECT * FROM messages
+    WHERE user_id = ? AND recipient = ? AND sender != ?
+    ORDER BY timestamp ASC
+    LIMIT ?
+'''
+_SQL_GET_MSGS_ALL = '''
+    SELECT * FROM messages
+    WHERE user_id = ?
+    ORDER BY timestamp ASC
+    LIMIT ?
+'''
+
+_SQL_ADD_PENDING = '''
+    INSERT INTO pending_messages (user_id, recipient, content, timestamp)
+    VALUES (?, ?, ?, ?)
+'''
+_SQL_GET_PENDING = '''
+    SELECT * FROM pending_messages
+    WHERE user_id = ? AND attempts < 3
+    ORDER BY timestamp ASC
+'''
+_SQL_COUNT_PENDING = '''
+    SELECT COUNT(*) FROM pending_messages
+    WHERE user_id = ? AND attempts < 3
+'''
+_SQL_DEL_PENDING = 'DELETE FROM pending_messages WHERE pending_id = ?'
+_SQL_INC_PENDING_ATTEMPTS = 'UPDATE pending_messages SET attempts = attempts + 1 WHERE pending_id = ?'
+_SQL_CLEAR_PENDING = 'DELETE FROM pending_messages WHERE user_id = ?'
+
 
 class MessageDatabase:
     """handles all database operations for the messaging app."""
 
-    def __init__(self, db_path='messenger.db'):
+    SYNC_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, db_path='messenger.db', sync_mode='NORMAL'):
         self.db_path = db_path
+        sync_mode = str(sync_mode).upper()
+        if sync_mode not in self.SYNC_MODES:
+            raise ValueError(f"unknown sync_mode: {sync_mode}")
+        self.sync_mode = sync_mode
+        # one long-lived connection per thread, tracked so close() can
+        # dispose of them all
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
         self._init_database()
 
+    def _open(self, database, pragmas, uri=False):
+        """open and register a new connection."""
+        conn = sqlite3.connect(
+            database,
+            uri=uri,
+            check_same_thread=False,
+            isolation_level=None,  # transactions are managed explicitly
+            cached_statements=512
+        )
+        conn.row_factory = sqlite3.Row
+        conn.executescript(pragmas)
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    def _get_conn(self):
+        """get (or lazily open) this thread's connection."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open(self.db_path, f'''
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous={self.sync_mode};
+                PRAGMA busy_timeout=5000;
+                PRAGMA temp_store=MEMORY;
+                PRAGMA cache_size=-20000;
+            ''')
+            self._local.conn = conn
+        return conn
+
+    def _get_read_conn(self):
+        """get (or lazily open) this thread's read-only connection.
+
+        reads on it run in autocommit mode, skipping the BEGIN/COMMIT
+        round trip of get_connection(). WAL lets them proceed while
+        another thread is writing.
+        """
+        conn = getattr(self._local, 'read_conn', None)
+        if conn is None:
+            uri = Path(self.db_path).resolve().as_uri() + '?mode=ro'
+            conn = self._open(uri, '''
+                PRAGMA temp_store=MEMORY;
+                PRAGMA cache_size=-20000;
+            ''', uri=True)
+            self._local.read_conn = conn
+        return conn
+
     @contextmanager
     def get_connection(self):
-        """context manager for database connections."""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        """context manager wrapping work in a transaction on the
+        thread's persistent connection."""
+        conn = self._get_conn()
+        if conn.in_transaction:
+            # nested use joins the enclosing transaction
+            yield conn
+            return
+
+        conn.execute('BEGIN')
         try:
             yield conn
-            conn.commit()
+            conn.execute('COMMIT')
         except Exception:
-            conn.rollback()
+            conn.execute('ROLLBACK')
             raise
-        finally:
-            conn.close()
+
+    def close(self):
+        """close every connection opened by this database."""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
 
     def _init_database(self):
         """create tables if they don't exist."""
-        with self.get_connection() as conn:
-            conn.executescript('''
-                -- users table
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    server TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-
-                -- contacts table
-                CREATE TABLE IF NOT EXISTS contacts (
-                    contact_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    friend_username TEXT NOT NULL,
-                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    UNIQUE(user_id, friend_username)
-                );
-
-                -- messages table
-                CREATE TABLE IF NOT EXISTS messages (
-                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    sender TEXT NOT NULL,
-                    recipient TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    timestamp REAL NOT NULL,
-                    is_sent BOOLEAN DEFAULT 1,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                );
-
-                -- pending messages (offline queue)
-                CREATE TABLE IF NOT EXISTS pending_messages (
-                    pending_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    recipient TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    timestamp REAL NOT NULL,
-                    attempts INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                );
-
-                -- indexes for performance
-                CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id);
-                CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp DESC);
-                CREATE INDEX IF NOT EXISTS idx_contacts_user ON contacts(user_id);
+        # executescript manages its own transaction, so skip get_connection
+        conn = self._get_conn()
+        conn.executescript(_SCHEMA_TABLES)
+        self._migrate_real_timestamps(conn)
+        conn.executescript(_SCHEMA_INDEXES)
+
+    @staticmethod
+    def _migrate_real_timestamps(conn):
+        """rebuild tables created when timestamps were REAL seconds."""
+        for table, ddl, columns in _TIMESTAMP_TABLES:
+            types = {row['name']: row['type'].upper() for row in
+                     conn.execute(f'PRAGMA table_info({table})')}
+            if types.get('timestamp') != 'REAL':
+                continue
+            converted = columns.replace(
+                'timestamp', 'CAST(ROUND(timestamp * 1000000) AS INTEGER)'
+            )
+            conn.executescript(f'''
+                BEGIN;
+                ALTER TABLE {table} RENAME TO {table}_real;
+                {ddl}
+                INSERT INTO {table} ({columns})
+                    SELECT {converted} FROM {table}_real;
+                DROP TABLE {table}_real;
+                COMMIT;
             ''')
 
     # user operations
     def get_or_create_user(self, username, password, server=None):
-        """get existing user or create new one. returns user_id."""
+        """get existing user or create new one. returns user_id.
+
+        a stored plain text password (legacy data) is replaced with its
+        hash on the way through.
+        """
+        row = self._get_read_conn().execute(
+            _SQL_GET_USER_AUTH, (username,)
+        ).fetchone()
+        if row and row['password_hash'] != password:
+            return row['user_id']
+
+        # new user or legacy password - run the (slow) hash outside any
+        # transaction so other writers aren't blocked on it
+        hashed = hash_password(password)
         with self.get_connection() as conn:
             cursor = conn.execute(
-                'SELECT user_id, password_hash FROM users WHERE username = ?',
-                (username,)
+                _SQL_UPSERT_USER, (username, hashed, server, password)
             )
-            row = cursor.fetchone()
-            if row:
-                # update password hash if it's plain text (migration)
-                if row['password_hash'] == password:
-                    hashed = hash_password(password)
-                    conn.execute(
-                        'UPDATE users SET password_hash = ? WHERE user_id = ?',
-                        (hashed, row['user_id'])
-                    )
-                return row['user_id']
-
-            # new user - hash the password
-            hashed = hash_password(password)
-            cursor = conn.execute(
-                'INSERT INTO users (username, password_hash, server) VALUES (?, ?, ?)',
-                (username, hashed, server)
-            )
-            return cursor.lastrowid
+            return cursor.fetchone()['user_id']
 
     def get_user(self, username):
         """get user by username."""
-        with self.get_connection() as conn:
-            cursor = conn.execute(
-                'SELECT * FROM users WHERE username = ?',
-                (username,)
-            )
-            return cursor.fetchone()
+        cursor = self._get_read_conn().execute(_SQL_GET_USER, (username,))
+        return cursor.fetchone()
 
     def update_user_password(self, username, password_hash):
         """update user password hash."""
         with self.get_connection() as conn:
-            conn.execute(
-                'UPDATE users SET password_hash = ? WHERE username = ?',
-                (password_hash, username)
-            )
+            conn.execute(_SQL_SET_HASH_BY_NAME, (password_hash, username))
 
     # contact operations
     def add_contact(self, user_id, friend_username):
         """add a contact for a user."""
         with self.get_connection() as conn:
             try:
-                conn.execute(
-                    'INSERT OR IGNORE INTO contacts (user_id, friend_username) VALUES (?, ?)',
-                    (user_id, friend_username)
-                )
+                conn.execute(_SQL_ADD_CONTACT, (user_id, friend_username))
             except sqlite3.IntegrityError:
                 pass  # already exists
 
     def get_contacts(self, user_id):
         """get all contacts for a user."""
-        with self.get_connection() as conn:
-            cursor = conn.execute(
-                'SELECT friend_username FROM contacts WHERE user_id = ? ORDER BY friend_username',
-                (user_id,)
-            )
-            return [row['friend_username'] for row in cursor.fetchall()]
+        cursor = self._get_read_conn().execute(_SQL_GET_CONTACTS, (user_id,))
+        return [row['friend_username'] for row in cursor.fetchall()]
 
     def remove_contact(self, user_id, friend_username):
         """remove a contact."""
         with self.get_connection() as conn:
-            conn.execute(
-                'DELETE FROM contacts WHERE user_id = ? AND friend_username = ?',
-                (user_id, friend_username)
-            )
+            conn.execute(_SQL_DEL_CONTACT, (user_id, friend_username))
 
     # message operations
     def add_message(self, user_id, sender, recipient, content, timestamp):
-        """add a message to the database."""
-        with self.get_connection() as conn:
-            conn.execute('''
-                INSERT INTO messages (user_id, sender, recipient, content, timestamp)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, sender, recipient, content, timestamp))
+        """add a message to the database.
 
-            # auto-add contacts from message participants
-            other_user = recipient if sender != recipient else sender
-            self.add_contact(user_id, other_user)
+        timestamp is in microseconds, see to_db_time().
+        """
+        self.add_messages_bulk(
+            user_id, [(sender, recipient, content, timestamp)]
+        )
+
+    def add_messages_bulk(self, user_id, msgs):
+        """add many messages in a single transaction.
+
+        msgs is an iterable of (sender, recipient, content, timestamp) tuples,
+        with timestamps in microseconds.
+
+        returns the message_id of the last one. the transaction holds the
+        write lock, so the ids are consecutive and msgs[i] gets
+        last_id - len(msgs) + 1 + i.
+        """
+        msgs = list(msgs)
+        if not msgs:
+            return None
+
+        # auto-add contacts from message participants
+        contacts = {
+            recipient if sender != recipient else sender
+            for sender, recipient, _, _ in msgs
+        }
+
+        with self.get_connection() as conn:
+            conn.executemany(
+                _SQL_ADD_MSG,
+                ((user_id, s, r, c, t) for s, r, c, t in msgs)
+            )
+            last_id = conn.execute(_SQL_LAST_ID).fetchone()[0]
+            conn.executemany(
+                _SQL_ADD_CONTACT,
+                [(user_id, username) for username in contacts]
+            )
+        return last_id
 
     def get_messages(self, user_id, other_username=None, limit=500):
         """get messages for a user, optionally filtered by conversation partner."""
-        with self.get_connection() as conn:
-            if other_username:
-                cursor = conn.execute('''
-                    SELECT * FROM messages
-                    WHERE user_id = ? AND (sender = ? OR recipient = ?)
-                    ORDER BY timestamp ASC
-                    LIMIT ?
-                ''', (user_id, other_username, other_username, limit))
-            else:
-                cursor = conn.execute('''
-                    SELECT * FROM messages
-                    WHERE user_id = ?
-                    ORDER BY timestamp ASC
-                    LIMIT ?
-                ''', (user_id, limit))
-            return cursor.fetchall()
+        conn = self._get_read_conn()
+        if other_username:
+            cursor = conn.execute(
+                _SQL_GET_MSGS_PEER,
+                (user_id, other_username,
+                 user_id, other_username, other_username, limit)
+            )
+        else:
+            cursor = conn.execute(_SQL_GET_MSGS_ALL, (user_id, limit))
+        return cursor.fetchall()
 
     def get_all_messages(self, user_id):
         """get all messages for a user."""
@@ -193,43 +391,55 @@ class MessageDatabase:
 
     # pending message operations (offline queue)
     def add_pending_message(self, user_id, recipient, content, timestamp):
-        """add a message to the offline queue."""
+        """add a message to the offline queue (timestamp in microseconds)."""
         with self.get_connection() as conn:
-            conn.execute('''
-                INSERT INTO pending_messages (user_id, recipient, content, timestamp)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, recipient, content, timestamp))
+            conn.execute(
+                _SQL_ADD_PENDING, (user_id, recipient, content, timestamp)
+            )
 
     def get_pending_messages(self, user_id):
         """get all pending messages for a user."""
-        with self.get_connection() as conn:
-            cursor = conn.execute('''
-                SELECT * FROM pending_messages
-                WHERE user_id = ? AND attempts < 3
-                ORDER BY timestamp ASC
-            ''', (user_id,))
-            return cursor.fetchall()
+        cursor = self._get_read_conn().execute(_SQL_GET_PENDING, (user_id,))
+        return cursor.fetchall()
+
+    def count_pending_messages(self, user_id):
+        """count pending messages for a user without fetching them."""
+        cursor = self._get_read_conn().execute(_SQL_COUNT_PENDING, (user_id,))
+        return cursor.fetchone()[0]
 
     def mark_pending_sent(self, pending_id):
         """remove a pending message after successful send."""
         with self.get_connection() as conn:
-            conn.execute(
-                'DELETE FROM pending_messages WHERE pending_id = ?',
-                (pending_id,)
-            )
+            conn.execute(_SQL_DEL_PENDING, (pending_id,))
+
+    def mark_pending_sent_bulk(self, pending_ids):
+        """remove many pending messages in a single transaction.
+
+        returns how many were actually removed, which is fewer than asked
+        for when some were already sent."""
+        return self._execute_per_id(_SQL_DEL_PENDING, pending_ids)
 
     def increment_pending_attempts(self, pending_id):
         """increment the attempt counter for a pending message."""
         with self.get_connection() as conn:
-            conn.execute(
-                'UPDATE pending_messages SET attempts = attempts + 1 WHERE pending_id = ?',
-                (pending_id,)
-            )
+            conn.execute(_SQL_INC_PENDING_ATTEMPTS, (pending_id,))
+
+    def increment_pending_attempts_bulk(self, pending_ids):
+        """increment the attempt counter for many pending messages."""
+        self._execute_per_id(_SQL_INC_PENDING_ATTEMPTS, pending_ids)
+
+    def _execute_per_id(self, sql, ids):
+        """run a single-id statement for every id in one transaction and
+        return the number of rows it changed.
+
+        the sql text never changes, so sqlite prepares it once and every
+        row reuses it (an `IN (?,?,...)` list would be a new statement for
+        each batch size)."""
+        with self.get_connection() as conn:
+            return conn.executemany(
+                sql, ((pending_id,) for pending_id in ids)).rowcount
 
     def clear_pending_messages(self, user_id):
         """clear all pending messages for a user."""
         with self.get_connection() as conn:
-            conn.execute(
-                'DELETE FROM pending_messages WHERE user_id = ?',
-                (user_id,)
-            )
+            conn.execute(_SQL_CLEAR_PENDING, (user_id,))
@@ -2,30 +2,134 @@
 """Module for direct messaging in the messaging system.
 Provides classes for representing and sending/receiving direct messages."""
 
+import select
+import selectors
 import socket
-from typing import List
-from ds_protocol import DirectMessagingProtocol
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Iterator, List, Tuple
+from ds_protocol import DirectMessagingProtocol, TYPE_OK
+
+# try to use ijson for streaming large replies, if available
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+# hot-path protocol helpers, resolved once
+_create_dm = DirectMessagingProtocol.create_direct_message
+_parse = DirectMessagingProtocol.parse_response
+
+_CRLF = b'\r\n'
+
+# sendmsg() gathers a line and its terminator into one writev(2);
+# windows doesn't have it
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# how a failed call is reported, most specific first
+_ERROR_LABELS = ((ConnectionError, "Connection error"),
+                 (OSError, "Socket error"))
+
+
+# the retrieve requests only vary with the token, so each is encoded once
+# per login instead of on every poll
+@lru_cache(maxsize=8)
+def _unread_request(token: str) -> bytes:
+    """Encoded request for unread messages"""
+    return DirectMessagingProtocol.request_unread_messages(
+        token).encode('utf-8')
+
+
+@lru_cache(maxsize=8)
+def _all_request(token: str) -> bytes:
+    """Encoded request for all messages"""
+    return DirectMessagingProtocol.request_all_messages(
+        token).encode('utf-8')
+
+
+def _resolve(future: Future, result: bool) -> None:
+    """Set a send_async future's result, unless the caller cancelled it"""
+    if future.set_running_or_notify_cancel():
+        future.set_result(result)
+
+
+def _log_error(action: str, e: Exception) -> None:
+    """Print a failed network call, labelled by the kind of error"""
+    for exc_type, label in _ERROR_LABELS:
+        if isinstance(e, exc_type):
+            break
+    else:
+        label = "Error"
+    print(f"{label} while {action}: {e}")
 
 
 class DirectMessage:
     """Represents a direct message with recipient, content, and timestamp."""
     # pylint: disable=too-few-public-methods
+    __slots__ = ('recipient', 'message', 'timestamp')
 
-    def __init__(self):
-        self.recipient = None  # user of the recipient
-        self.message = None    # content of the message
-        self.timestamp = None  # when the message was sent/received
+    def __init__(self, recipient=None, message=None, timestamp=None):
+        self.recipient = recipient  # user of the recipient
+        self.message = message      # content of the message
+        self.timestamp = timestamp  # when the message was sent/received
 
     def is_valid(self) -> bool:
         """Check if the message has all required fields."""
         return self.message is not None
 
 
+def build_dms(raw: list) -> List[DirectMessage]:
+    """Build DirectMessages from the records of an 'all' reply"""
+    # received messages carry 'from', sent ones 'recipient'
+    return [DirectMessage(m.get('from') or m.get('recipient'),
+                          m.get('message'), m.get('timestamp'))
+            for m in raw]
+
+
+class _LineReader:
+    """File-like view of the rest of one received line, for ijson"""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, messenger):
+        self._messenger = messenger
+        self._done = False
+
+    def read(self, size: int = 65536) -> bytes:
+        """Return up to size bytes of the line, b'' once it has ended"""
+        if self._done:
+            return b''
+        buf = self._messenger._rxbuf  # pylint: disable=protected-access
+        if not buf:
+            chunk = self._messenger.socket.recv(65536)
+            if not chunk:
+                raise ConnectionError("Connection closed by server")
+            buf += chunk
+        i = buf.find(b'\n', 0, size)
+        if i >= 0:
+            size = i + 1
+            self._done = True
+        data = bytes(buf[:size])
+        del buf[:size]
+        return data
+
+    def drain(self) -> None:
+        """Discard whatever is left of the line"""
+        while self.read():
+            pass
+
+
 class DirectMessenger:
     """Handles direct messaging operations
     including connection, authentication,
     and message sending/retrieving."""
     # pylint: disable=too-many-instance-attributes
+    auth_timeout = 5.0  # seconds to wait for connect + join
+    reply_timeout = 30.0  # seconds to wait for send_async replies
 
     def __init__(self, dsuserver=None, username=None, password=None):
         self.token = None          # auth token
@@ -35,165 +139,408 @@ class DirectMessenger:
         self.port = 3001          # port for server connection
         # Connection components
         self.socket = None
-        self.send_stream = None
-        self.recv_stream = None
+        self._rxbuf = bytearray()  # received bytes not yet split into lines
+        # send_async bookkeeping: futures waiting for a reply, in send order
+        self._pipeline = deque()
+        self._pipe_lock = threading.Lock()
+        self._reader = None        # thread reading pipelined replies
 
     def connect(self) -> bool:
         """Establish connection to the server and also authenticate"""
         try:
             # create new socket connection
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # don't hang forever on a server that never answers the join
+            self.socket.settimeout(self.auth_timeout)
             self.socket.connect((self.dsuserver, self.port))
-
-            # treat as files (so its easier)
-            self.send_stream = self.socket.makefile('w')
-            self.recv_stream = self.socket.makefile('r')
+            # requests are single small lines, don't hold them back
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._set_keepalive()
+            self._rxbuf = bytearray()
 
             # authenticate with the server
             if self.username and self.password:
                 join_msg = DirectMessagingProtocol.create_join(
                     self.username, self.password)
-                self.send_stream.write(join_msg + '\r\n')
-                self.send_stream.flush()
+                self._send_line(join_msg)
 
-                response = DirectMessagingProtocol.parse_response(
-                    self.recv_stream.readline())
-                if response and response.type == 'ok':
+                response = self._parse_line(
+                    DirectMessagingProtocol.parse_response)
+                if response and response.type is TYPE_OK:
                     self.token = response.token
+                    self.socket.settimeout(None)
                     return True
             return False
-        except ConnectionError as e:
-            print(f"Connection error: {e}")
-            self.close()
-            return False
-        except socket.error as e:
-            print(f"Socket error: {e}")
-            self.close()
-            return False
         except Exception as e:  # pylint: disable=broad-except
-            print(f"Unexpected error: {e}")
+            _log_error("connecting", e)
             self.close()
             return False
 
+    def _set_keepalive(self) -> None:
+        """Turn on TCP keepalive so an idle connection stays usable"""
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # the tuning knobs are only there on some platforms (linux)
+        for name, value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 15),
+                            ('TCP_KEEPCNT', 4)):
+            opt = getattr(socket, name, None)
+            if opt is not None:
+                self.socket.setsockopt(socket.IPPROTO_TCP, opt, value)
+
+    def _ensure_connected(self) -> bool:
+        """Make sure there is a live, authenticated connection
+
+        Reuses the current socket unless there is no token yet or the
+        server has closed it (readable with nothing left to read)."""
+        self._wait_pipeline()
+        if not self.token or self.socket is None:
+            return self.connect()
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+            if not readable or self.socket.recv(1, socket.MSG_PEEK):
+                return True
+        except (OSError, ValueError):
+            pass
+        # connection is gone, start over
+        self.close()
+        self.token = None
+        return self.connect()
+
     def send(self, message: str, recipient: str) -> bool:
         """Send a direct message to another user"""
-        if not self.token:
-            if not self.connect():
-                return False
+        if not self._ensure_connected():
+            return False
 
         try:
             # create and send the direct message
-            dm_msg = DirectMessagingProtocol.create_direct_message(
-                self.token, message, recipient)
-            self.send_stream.write(dm_msg + '\r\n')
-            self.send_stream.flush()
+            self._send_line_bytes(
+                _create_dm(self.token, message, recipient).encode('utf-8'))
 
             # get then parse the response
-            response = DirectMessagingProtocol.parse_response(
-                self.recv_stream.readline())
-            return response and response.type == 'ok'
+            response = self._parse_line(_parse)
+            return response is not None and response.type is TYPE_OK
 
-        except ConnectionError as e:
-            print(f"Connection error while sending message: {e}")
-            return False
-        except socket.error as e:
-            print(f"Socket error while sending message: {e}")
-            return False
         except Exception as e:  # pylint: disable=broad-except
-            print(f"Error sending message: {e}")
+            _log_error("sending message", e)
             return False
 
+    def send_async(self, message: str, recipient: str) -> Future:
+        """Send a direct message without waiting for the reply
+
+        The request is written right away; replies are read on a
+        background thread and resolve the returned futures (to True if
+        the server accepted the message) in the order they were sent."""
+        future = Future()
+        with self._pipe_lock:
+            if self._reader is None and not self._ensure_connected():
+                future.set_result(False)
+                return future
+            try:
+                self._send_line_bytes(
+                    _create_dm(self.token, message, recipient).encode('utf-8'))
+            except OSError as e:
+                print(f"Socket error while sending message: {e}")
+                future.set_result(False)
+                return future
+            self._pipeline.append(future)
+            if self._reader is None:
+                self._reader = threading.Thread(
+                    target=self._read_pipeline, args=(self.socket,),
+                    daemon=True)
+                self._reader.start()
+        return future
+
+    def _read_pipeline(self, sock) -> None:
+        """Resolve send_async futures from the server's replies
+
+        Runs until no futures are left. Waits on a selector with a timeout
+        so that a closed or replaced socket ends the loop."""
+        me = threading.current_thread()
+        sel = selectors.DefaultSelector()
+        try:
+            sel.register(sock, selectors.EVENT_READ)
+            while True:
+                with self._pipe_lock:
+                    if self._reader is not me:
+                        return  # given up on by _wait_pipeline
+                    if not self._pipeline:
+                        self._reader = None
+                        return
+                    future = self._pipeline[0]
+                while b'\n' not in self._rxbuf:
+                    if self._reader is not me:
+                        return  # given up on by _wait_pipeline
+                    if sock is not self.socket:
+                        raise ConnectionError("Connection was replaced")
+                    if sel.select(timeout=0.5):
+                        chunk = sock.recv(65536)
+                        if not chunk:
+                            raise ConnectionError(
+                                "Connection closed by server")
+                        self._rxbuf += chunk
+                response = self._parse_line(_parse)
+                with self._pipe_lock:
+                    self._pipeline.popleft()
+                _resolve(future,
+                         response is not None and response.type is TYPE_OK)
+        except (OSError, ValueError) as e:
+            print(f"Connection error while reading replies: {e}")
+        finally:
+            sel.close()
+            # on any error, fail what is still waiting so no caller hangs,
+            # and let the next send_async start a new reader
+            with self._pipe_lock:
+                if self._reader is me:
+                    self._fail_pipeline()
+
+    def _fail_pipeline(self) -> None:
+        """Resolve every waiting send_async future to False and forget
+        the reader (call with _pipe_lock held)"""
+        while self._pipeline:
+            _resolve(self._pipeline.popleft(), False)
+        self._reader = None
+
+    def _wait_pipeline(self) -> None:
+        """Wait until all send_async replies have been read, so the
+        socket can be used synchronously again
+
+        If the replies don't come within reply_timeout the waiting
+        futures are failed and the connection is dropped, so the next
+        call reconnects instead of hanging on a silent server."""
+        reader = self._reader
+        if reader is None or reader is threading.current_thread():
+            return
+        reader.join(self.reply_timeout)
+        if reader.is_alive():
+            print("Timed out waiting for replies")
+            with self._pipe_lock:
+                if self._reader is reader:
+                    self._fail_pipeline()
+            self.close()
+            self.token = None
+
+    def send_many(self, messages: List[Tuple[str, str]]) -> List[bool]:
+        """Send several (message, recipient) pairs in one write
+
+        All requests go out in a single sendall, then one response is read
+        per message. Returns whether each message was accepted."""
+        if not messages:
+            return []
+        if not self._ensure_connected():
+            return [False] * len(messages)
+
+        try:
+            self.socket.sendall(
+                DirectMessagingProtocol.create_direct_messages_batch(
+                    self.token, messages))
+
+            results = []
+            for _ in messages:
+                response = self._parse_line(
+                    DirectMessagingProtocol.parse_response)
+                results.append(bool(response and response.type is TYPE_OK))
+            return results
+
+        except Exception as e:  # pylint: disable=broad-except
+            _log_error("sending messages", e)
+        return [False] * len(messages)
+
+    @contextmanager
+    def cork(self):
+        """Hold back partial segments while several sends are made
+
+        Uses TCP_CORK where the platform has it (linux); elsewhere this
+        does nothing."""
+        cork_opt = getattr(socket, 'TCP_CORK', None)
+        if cork_opt is None or self.socket is None:
+            yield
+            return
+        self.socket.setsockopt(socket.IPPROTO_TCP, cork_opt, 1)
+        try:
+            yield
+        finally:
+            self.socket.setsockopt(socket.IPPROTO_TCP, cork_opt, 0)
+
     def retrieve_new(self) -> List[DirectMessage]:
         """Retrieve new (unread) messages"""
-        if not self.token:
-            if not self.connect():
-                return []
+        if not self._ensure_connected():
+            return []
 
         try:
             # request new messages.
-            request = DirectMessagingProtocol.request_unread_messages(
-                self.token)
-            self.send_stream.write(request + '\r\n')
-            self.send_stream.flush()
+            self._send_line_bytes(_unread_request(self.token))
 
             # get and parse the response
-            response = DirectMessagingProtocol.parse_messages(
-                self.recv_stream.readline())
-
-            if response and response.type == 'ok':
-                messages = []
-                for msg in response.messages:
-                    dm = DirectMessage()
-                    dm.message = msg.get('message')
-                    dm.recipient = msg.get('from')
-                    # for received messages, note :'from' is the sender
-                    dm.timestamp = msg.get('timestamp')
-                    messages.append(dm)
-                return messages
-            return []
+            response = self._parse_line(
+                DirectMessagingProtocol.parse_messages)
 
-        except ConnectionError as e:
-            print(f"Connection error while retrieving messages: {e}")
-            return []
-        except socket.error as e:
-            print(f"Socket error while retrieving messages: {e}")
+            if response and response.type is TYPE_OK:
+                # for received messages, note :'from' is the sender
+                return [DirectMessage(m.get('from'), m.get('message'),
+                                      m.get('timestamp'))
+                        for m in response.messages]
             return []
+
         except Exception as e:  # pylint: disable=broad-except
-            print(f"Error retrieving new messages: {e}")
+            _log_error("retrieving new messages", e)
             return []
 
     def retrieve_all(self) -> List[DirectMessage]:
         """Retrieve all messages"""
-        if not self.token:
-            if not self.connect():
-                return []
+        if not self._ensure_connected():
+            return []
 
         try:
             # request all messages
-            request = DirectMessagingProtocol.request_all_messages(
-                self.token)
-            self.send_stream.write(request + '\r\n')
-            self.send_stream.flush()
+            self._send_line_bytes(_all_request(self.token))
 
             # get and parse the response
-            response = DirectMessagingProtocol.parse_messages(
-                self.recv_stream.readline())
-
-            if response and response.type == 'ok':
-                messages = []
-                for msg in response.messages:
-                    dm = DirectMessage()
-                    dm.message = msg.get('message')
-                    # determine if message was sent or received
-                    if 'from' in msg:
-                        dm.recipient = msg.get('from')
-                        # msg received
-                    else:
-                        dm.recipient = msg.get('recipient')
-                        # msg sent
-                    dm.timestamp = msg.get('timestamp')
-                    messages.append(dm)
-                return messages
-            return []
+            response = self._parse_line(
+                DirectMessagingProtocol.parse_messages)
 
-        except ConnectionError as e:
-            print(f"Connection error while retrieving all messages: {e}")
-            return []
-        except socket.error as e:
-            print(f"Socket error while retrieving all messages: {e}")
+            if response and response.type is TYPE_OK:
+                return build_dms(response.messages)
             return []
+
         except Exception as e:  # pylint: disable=broad-except
-            print(f"Error retrieving all messages: {e}")
+            _log_error("retrieving all messages", e)
             return []
 
+    def iter_all(self) -> Iterator[DirectMessage]:
+        """Yield all messages as they are parsed off the socket
+
+        With ijson installed the messages array is streamed, so a large
+        history is never held in memory at once and the first message is
+        available before the whole reply has arrived. Without it this
+        just iterates over retrieve_all()."""
+        if not HAS_IJSON:
+            yield from self.retrieve_all()
+            return
+        if not self._ensure_connected():
+            return
+
+        reader = None
+        try:
+            self._send_line_bytes(_all_request(self.token))
+            reader = _LineReader(self)
+            for m in ijson.items(reader, 'response.messages.item',
+                                 use_float=True):
+                # received messages carry 'from', sent ones 'recipient'
+                yield DirectMessage(m.get('from') or m.get('recipient'),
+                                    m.get('message'), m.get('timestamp'))
+            # leave the socket at the start of the next reply, even if
+            # the caller stopped iterating early
+            reader.drain()
+            reader = None
+        except (OSError, ijson.JSONError) as e:
+            print(f"Error streaming all messages: {e}")
+            reader = None
+            self.close()
+            self.token = None
+        finally:
+            if reader is not None:
+                reader.drain()
+
+    def _send_line(self, msg: str) -> None:
+        """Send one protocol line straight to the socket"""
+        self._send_line_bytes(msg.encode('utf-8'))
+
+    def _send_line_bytes(self, data: bytes) -> None:
+        """Send data plus the line terminator without joining them first"""
+        if not _HAS_SENDMSG:
+            self.socket.sendall(data + _CRLF)
+            return
+        sent = self.socket.sendmsg((data, _CRLF))
+        if sent < len(data) + 2:
+            # partial write, send whatever is left
+            self.socket.sendall((data + _CRLF)[sent:])
+
+    def _readline_bytes(self) -> bytes:
+        """Read one line from the socket (without the newline)
+
+        Reads in large chunks into a buffer and splits lines out of it,
+        instead of going through a text-mode file wrapper."""
+        i = self._fill_line()
+        line = bytes(memoryview(self._rxbuf)[:i])
+        del self._rxbuf[:i + 1]
+        return line
+
+    def _parse_line(self, parse):
+        """Read one line and hand it to parse without copying it
+
+        The parser sees a memoryview into the receive buffer, which
+        orjson reads in place; the line is dropped from the buffer
+        afterwards."""
+        i = self._fill_line()
+        with memoryview(self._rxbuf) as view, view[:i] as line:
+            result = parse(line)
+        del self._rxbuf[:i + 1]
+        return result
+
+    def _fill_line(self) -> int:
+        """Receive until the buffer holds a full line; return the index
+        of its newline"""
+        start = 0
+        while True:
+            i = self._rxbuf.find(b'\n', start)
+            if i >= 0:
+                return i
+            # only bytes received from here on can hold the newline
+            start = len(self._rxbuf)
+            # a long reply is still arriving: ask for at least as much
+            # again, so big replies take few recv calls
+            chunk = self.socket.recv(max(65536, start))
+            if not chunk:
+                raise ConnectionError("Connection closed by server")
+            self._rxbuf += chunk
+
     def close(self):
         """Close the connection to the server"""
+        if self.socket is None:
+            return  # never connected, or already closed
+        sock, self.socket = self.socket, None
         try:
-            if self.send_stream:
-                self.send_stream.close()
-            if self.recv_stream:
-                self.recv_stream.close()
-            if self.socket:
-                self.socket.close()
+            sock.close()
         except Exception as e:  # pylint: disable=broad-except
             print(f"Error closing connection: {e}")
+
+
+class DirectMessengerPool:
+    """A fixed set of authenticated DirectMessengers for concurrent callers
+
+    Every messenger has its own connection, so calls made from different
+    threads go out in parallel instead of queueing on one socket."""
+
+    def __init__(self, dsuserver=None, username=None, password=None,
+                 size: int = 4):
+        self._idle = queue.Queue(maxsize=size)
+        self._messengers = [DirectMessenger(dsuserver, username, password)
+                            for _ in range(size)]
+        # connect + join round trips happen side by side
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            list(executor.map(DirectMessenger.connect, self._messengers))
+        for messenger in self._messengers:
+            self._idle.put(messenger)
+
+    @contextmanager
+    def _borrow(self):
+        """Take an idle messenger for the duration of one call"""
+        messenger = self._idle.get()
+        try:
+            yield messenger
+        finally:
+            self._idle.put(messenger)
+
+    def send(self, message: str, recipient: str) -> bool:
+        """Send a direct message over any free connection"""
+        with self._borrow() as messenger:
+            return messenger.send(message, recipient)
+
+    def retrieve_new(self) -> List[DirectMessage]:
+        """Retrieve new (unread) messages over any free connection"""
+        with self._borrow() as messenger:
+            return messenger.retrieve_new()
+
+    def close(self):
+        """Close every connection in the pool"""
+        for messenger in self._messengers:
+            messenger.close()
@@ -2,13 +2,107 @@
 """Protocol module for the messaging system that handles message formatting
 and parsing for communication."""
 
-from collections import namedtuple
-import json
+from json.encoder import encode_basestring_ascii
+import sys
 import time
+from typing import List, NamedTuple, Union
 
-# Responses
-ServerResponse = namedtuple('ServerResponse', ['type', 'message', 'token'])
-MessageResponse = namedtuple('MessageResponse', ['type', 'messages'])
+import jsonutil
+
+# Responses (tuples, so no per-instance dict; the parsers build them
+# positionally, which is quicker than by keyword)
+class ServerResponse(NamedTuple):
+    """A reply to a join or direct message"""
+    type: str
+    message: str
+    token: str
+
+
+class MessageResponse(NamedTuple):
+    """A reply to a request for messages"""
+    type: str
+    messages: List[dict]
+
+
+# response types are normalized to these interned strings when parsed,
+# so callers can compare with `is`
+TYPE_OK = sys.intern('ok')
+TYPE_ERROR = sys.intern('error')
+_TYPES = {TYPE_OK: TYPE_OK, TYPE_ERROR: TYPE_ERROR}
+
+
+def _jstr(value) -> str:
+    """JSON-encode a field for the request templates
+
+    Strings go straight to the json module's C string escaper, skipping
+    the general-purpose encoder; anything else (e.g. a None token) takes
+    the normal path."""
+    if value.__class__ is str:
+        return encode_basestring_ascii(value)
+    return jsonutil.dumps_str(value)
+
+
+# JSON whitespace, as str characters and as byte values
+_BLANKS = frozenset(' \t\r\n') | frozenset(b' \t\r\n')
+
+
+def _can_be_object(data) -> bool:
+    """Whether data starts (after any blanks) with '{', i.e. could be a
+    reply at all; anything else is turned away without paying for a parse
+    and the exception it would end in
+
+    Only indexes data, so a memoryview into the receive buffer isn't
+    sliced (which would leave another export of the buffer alive)."""
+    if not data:
+        return False
+    first = data[0]
+    if first == '{' or first == 0x7b:
+        return True
+    if first not in _BLANKS:
+        return False
+    # leading whitespace is valid JSON, though the server never sends it
+    if first.__class__ is str:
+        return data.lstrip()[:1] == '{'
+    return bytes(data).lstrip()[:1] == b'{'
+
+
+def _report_error(e: Exception) -> None:
+    """Print why a reply couldn't be parsed"""
+    print(f"Error parsing response ({type(e).__name__}): {e}")
+
+
+def _load_reply(json_msg):
+    """Decode a reply line, or return None if it isn't valid JSON"""
+    if not _can_be_object(json_msg):
+        return None
+    try:
+        return jsonutil.loads(json_msg)
+    except Exception as e:  # pylint: disable=broad-except
+        # bad JSON
+        _report_error(e)
+    return None
+
+
+def _response_body(json_obj):
+    """Return the 'response' object of a parsed reply, or None if the
+    reply doesn't have one (checked up front rather than by catching
+    the errors a malformed reply would raise)"""
+    if not isinstance(json_obj, dict):
+        return None
+    resp = json_obj.get('response')
+    return resp if isinstance(resp, dict) else None
+
+
+def _dm_line(tok: str, message: str, recipient: str) -> str:
+    """One direct message request, tok already JSON-encoded
+
+    Built as a single f-string, which compiles to direct string building
+    rather than a str.format call; the timestamp is only digits and a dot,
+    so it needs no escaping."""
+    secs, nanos = divmod(time.time_ns(), 1_000_000_000)
+    return (f'{{"token":{tok},"directmessage":{{"entry":{_jstr(message)},'
+            f'"recipient":{_jstr(recipient)},'
+            f'"timestamp":"{secs}.{nanos:09d}"}}}}')
 
 
 class DirectMessagingProtocol:
@@ -20,86 +114,96 @@ class DirectMessagingProtocol:
     # directly (can also
     # use regular, but it would unnecessarily store the methods)
 
+    # fixed-shape requests, kept as the constant JSON between their
+    # fields; only the json-escaped fields are joined in between (plain
+    # concatenation beats str.format)
+    _JOIN_HEAD = '{"join":{"username":'
+    _JOIN_MID = ',"password":'
+    _JOIN_TAIL = ',"token":""}}'
+    # the message requests only vary in the token
+    _TOKEN_HEAD = '{"token":'
+    _UNREAD_TAIL = ',"directmessage":"new"}'
+    _ALL_TAIL = ',"directmessage":"all"}'
+
     @staticmethod
     def create_join(username: str, password: str) -> str:
         """Creates a join message"""
-        return json.dumps({
-            "join": {
-                "username": username,
-                "password": password,
-                "token": ""
-            }
-        })
+        dmp = DirectMessagingProtocol
+        return (dmp._JOIN_HEAD + _jstr(username) + dmp._JOIN_MID
+                + _jstr(password) + dmp._JOIN_TAIL)
 
     @staticmethod
     def create_direct_message(token: str, message: str, recipient: str) -> str:
         """Creates a direct message"""
-        return json.dumps({
-            "token": token,
-            "directmessage": {
-                "entry": message,
-                "recipient": recipient,
-                "timestamp": str(time.time())
-            }
-        })
+        return _dm_line(_jstr(token), message, recipient)
+
+    @staticmethod
+    def create_direct_messages_batch(token: str, pairs) -> bytes:
+        """Creates direct messages for (message, recipient) pairs as
+        CRLF-terminated lines, encoded once and ready to write"""
+        tok = _jstr(token)
+        lines = [_dm_line(tok, message, recipient)
+                 for message, recipient in pairs]
+        lines.append('')
+        return '\r\n'.join(lines).encode('utf-8')
 
     @staticmethod
     def request_unread_messages(token: str) -> str:
         """Creates a request for unread messages"""
-        return json.dumps({
-            "token": token,
-            "directmessage": "new"
-        })
+        return (DirectMessagingProtocol._TOKEN_HEAD + _jstr(token)
+                + DirectMessagingProtocol._UNREAD_TAIL)
 
     @staticmethod
     def request_all_messages(token: str) -> str:
         """Creates a request for all messages"""
-        return json.dumps({
-            "token": token,
-            "directmessage": "all"
-        })
+        return (DirectMessagingProtocol._TOKEN_HEAD + _jstr(token)
+                + DirectMessagingProtocol._ALL_TAIL)
 
     @staticmethod
-    def parse_response(json_msg: str) -> ServerResponse:
-        """Parses server response"""
+    def _build_response(json_obj) -> ServerResponse:
+        """Builds a ServerResponse from an already parsed reply"""
         try:
-            json_obj = json.loads(json_msg)
-            if 'response' in json_obj:
-                resp = json_obj['response']
+            resp = _response_body(json_obj)
+            if resp is not None:
+                rtype = resp.get('type')
                 return ServerResponse(
-                    type=resp.get('type'),
-                    message=resp.get('message', ''),
-                    token=resp.get('token', '')
+                    _TYPES.get(rtype, rtype),
+                    resp.get('message', ''),
+                    resp.get('token', '')
                 )
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON response: {e}")
-            print(f"Invalid JSON: {json_msg}")
-        except KeyError as e:
-            print(f"Missing key in response: {e}")
-        except AttributeError as e:
-            print(f"Invalid attribute access in response: {e}")
         except Exception as e:  # pylint: disable=broad-except
-            print(f"Unexpected error parsing response: {e}")
+            # a reply whose fields aren't what we expect
+            _report_error(e)
         return None
 
     @staticmethod
-    def parse_messages(json_msg: str) -> MessageResponse:
-        """Parses message response"""
+    def _build_messages(json_obj) -> MessageResponse:
+        """Builds a MessageResponse from an already parsed reply"""
         try:
-            json_obj = json.loads(json_msg)
-            if 'response' in json_obj:
-                resp = json_obj['response']
+            resp = _response_body(json_obj)
+            if resp is not None:
+                rtype = resp.get('type')
                 return MessageResponse(
-                    type=resp.get('type'),
-                    messages=resp.get('messages', [])
+                    _TYPES.get(rtype, rtype),
+                    resp.get('messages', [])
                 )
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON response: {e}")
-            print(f"Invalid JSON: {json_msg}")
-        except KeyError as e:
-            print(f"Missing key in response: {e}")
-        except AttributeError as e:
-            print(f"Invalid attribute access in response: {e}")
         except Exception as e:  # pylint: disable=broad-except
-            print(f"Unexpected error parsing response: {e}")
+            # a reply whose fields aren't what we expect
+            _report_error(e)
         return None
+
+    @staticmethod
+    def parse_response(json_msg: Union[str, bytes]) -> ServerResponse:
+        """Parses server response"""
+        json_obj = _load_reply(json_msg)
+        if json_obj is None:
+            return None
+        return DirectMessagingProtocol._build_response(json_obj)
+
+    @staticmethod
+    def parse_messages(json_msg: Union[str, bytes]) -> MessageResponse:
+        """Parses message response"""
+        json_obj = _load_reply(json_msg)
+        if json_obj is None:
+            return None
+        return DirectMessagingProtocol._build_messages(json_obj)
@@ -0,0 +1,68 @@
+# jsonutil.py
+"""JSON helpers that use orjson when it is available."""
+
+import json
+
+# try to use orjson if available, otherwise use the stdlib json module
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# without orjson, parse with ujson, or failing that simdjson, if available
+try:
+    import ujson
+    HAS_UJSON = True
+except ImportError:
+    HAS_UJSON = False
+
+try:
+    import simdjson
+    HAS_SIMDJSON = True
+except ImportError:
+    HAS_SIMDJSON = False
+
+
+def dumps(obj, default=None) -> bytes:
+    """serialize obj to utf-8 encoded json bytes."""
+    if HAS_ORJSON:
+        return orjson.dumps(obj, default=default)
+    return json.dumps(obj, default=default).encode('utf-8')
+
+
+def dumps_str(obj) -> str:
+    """serialize obj to a json str."""
+    if HAS_ORJSON:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj)
+
+
+def loads(data):
+    """parse json from str, bytes, bytearray or memoryview.
+
+    decode errors are raised as json.JSONDecodeError (orjson's error
+    type subclasses it).
+    """
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    if HAS_UJSON:
+        if isinstance(data, memoryview):
+            # ujson doesn't take buffers either
+            data = bytes(data)
+        try:
+            return ujson.loads(data)
+        except ValueError:
+            # ujson's own error type; let the stdlib raise the usual one
+            pass
+    elif HAS_SIMDJSON:
+        try:
+            return simdjson.loads(data)
+        except (ValueError, RuntimeError):
+            # invalid json, or valid json simdjson can't represent (ints
+            # over 64 bits); the stdlib gives the usual result or error
+            pass
+    if isinstance(data, memoryview):
+        # the stdlib parser doesn't take buffers
+        data = bytes(data)
+    return json.loads(data)
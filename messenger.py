@@ -4,30 +4,59 @@ Multi-threaded messaging application with GUI.
 Features proper thread isolation, connection recovery, and offline message queuing.
 """
 
+import atexit
 import threading
 import queue
 import logging
+import logging.handlers
+from collections import OrderedDict, deque
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 import time
 from enum import Enum
+from operator import attrgetter
 from typing import Optional
 
 from ds_messenger import DirectMessenger
-from database import MessageDatabase
+from database import MessageDatabase, to_db_time
 from config import Config
 
-# logging setup
+# logging setup - the calling thread still merges the message arguments
+# (QueueHandler.prepare formats the record before queueing it); the
+# listener thread adds the timestamp/level prefix and does the file and
+# console writes
+_log_queue = queue.SimpleQueue()
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('messenger.log'),
-        logging.StreamHandler()
-    ]
+    format='%(message)s',  # the listener's handlers add the rest
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+_log_format = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+_log_handlers = [logging.FileHandler('messenger.log'), logging.StreamHandler()]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_format)
+_log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
+# conversations kept in memory for redraws (least recently viewed dropped)
+MESSAGE_CACHE_SIZE = 16
+
+# most outgoing messages the network worker takes off the queue at once
+OUTGOING_BATCH_SIZE = 32
+
+# (content, sender, timestamp) of a received message; on a DirectMessage
+# the 'recipient' field holds the sender
+_dm_fields = attrgetter('message', 'recipient', 'timestamp')
+
+
+def _dict_fields(msg):
+    """(content, sender, timestamp) of a received message given as a dict."""
+    return msg.get('message'), msg.get('from'), msg.get('timestamp')
+
 
 class ConnectionState(Enum):
     """connection states for status display."""
@@ -50,12 +79,17 @@ class MessengerApp:
     def __init__(self):
         # config and database
         self.config = Config()
-        self.db = MessageDatabase(self.config.db_path)
+        self.db = MessageDatabase(self.config.db_path, self.config.sync_mode)
 
         # thread synchronization
-        self.incoming_queue = queue.Queue()  # network -> gui
-        self.outgoing_queue = queue.Queue()  # gui -> network
+        # network -> gui. deque append/popleft are atomic, so the network
+        # and polling threads can both append without taking a lock
+        self.incoming_queue = deque()
+        self.outgoing_queue = queue.Queue(  # gui -> network
+            maxsize=self.config.max_outgoing_queue
+        )
         self.stop_event = threading.Event()
+        self.work_event = threading.Event()  # set when outgoing work is queued
 
         # threads
         self.network_thread: Optional[threading.Thread] = None
@@ -67,11 +101,27 @@ class MessengerApp:
         self.retry_count = 0
         self.backoff_time = 1
 
+        # number of queued (pending) messages, kept in step with the db so
+        # the status bar doesn't have to query it
+        self.pending_count = 0
+        self._pending_lock = threading.Lock()
+        self._shown_pending = None  # count currently on the status bar
+
         # user state
         self.user_id: Optional[int] = None
         self.username: Optional[str] = None
         self.password: Optional[str] = None
         self.current_recipient: Optional[str] = None
+        # (user_id, contact) -> [(sender, content), ...]; gui thread only
+        self._msg_cache = OrderedDict()
+        # contact -> contacts_tree item id for the rows currently shown
+        self._contact_iids = {}
+
+        # incoming_queue event type -> handler
+        self._handlers = {
+            'new_messages_batch': self._on_new_messages,
+            'sent_success_batch': self._on_sent_success,
+        }
 
         # gui setup
         self.root = tk.Tk()
@@ -210,6 +260,9 @@ class MessengerApp:
             self.user_id = self.db.get_or_create_user(
                 username, password, server
             )
+            with self._pending_lock:
+                self.pending_count = self.db.count_pending_messages(
+                    self.user_id)
 
             # try to connect
             if self._connect():
@@ -247,14 +300,14 @@ class MessengerApp:
             if self.messenger.connect():
                 self._update_connection_state(ConnectionState.CONNECTED)
                 self.retry_count = 0
-                logger.info(f"Connected to server as {self.username}")
+                logger.info("Connected to server as %s", self.username)
                 return True
 
             self._update_connection_state(ConnectionState.DISCONNECTED)
             return False
 
         except Exception as e:
-            logger.error(f"Connection error: {e}")
+            logger.error("Connection error: %s", e)
             self._update_connection_state(ConnectionState.DISCONNECTED)
             return False
 
@@ -293,55 +346,134 @@ class MessengerApp:
             try:
                 # check outgoing queue
                 try:
-                    msg_data = self.outgoing_queue.get(timeout=0.5)
+                    msg_data = self.outgoing_queue.get_nowait()
                 except queue.Empty:
+                    # sleep until something is queued (or shutdown); clearing
+                    # before the queue is checked again means no lost wakeups
+                    self.work_event.wait()
+                    self.work_event.clear()
                     continue
 
-                recipient = msg_data['recipient']
-                content = msg_data['content']
-                timestamp = msg_data['timestamp']
-                is_retry = msg_data.get('is_retry', False)
-                pending_id = msg_data.get('pending_id')
+                # take whatever else is already waiting so the sends and
+                # their db writes are done together
+                items = [msg_data]
+                while len(items) < OUTGOING_BATCH_SIZE:
+                    try:
+                        items.append(self.outgoing_queue.get_nowait())
+                    except queue.Empty:
+                        break
 
-                # try to send
-                if self.connection_state == ConnectionState.CONNECTED:
-                    if self.messenger and self.messenger.send(content, recipient):
-                        # success - save to db
-                        self.db.add_message(
-                            self.user_id, self.username,
-                            recipient, content, timestamp
-                        )
-                        if pending_id:
-                            self.db.mark_pending_sent(pending_id)
-
-                        self.incoming_queue.put({
-                            'type': 'sent_success',
-                            'recipient': recipient
-                        })
-                        logger.info(f"Sent message to {recipient}")
-                    else:
-                        # send failed - queue for retry
-                        self._handle_send_failure(msg_data)
-                else:
-                    # offline - queue the message
-                    if not is_retry:
-                        self.db.add_pending_message(
-                            self.user_id, recipient, content, timestamp
-                        )
-                        logger.info(f"Queued offline message to {recipient}")
+                self._send_outgoing(items)
 
             except Exception as e:
-                logger.error(f"Network worker error: {e}")
+                logger.error("Network worker error: %s", e)
+
+    def _send_outgoing(self, items):
+        """send a drained run of outgoing messages, one write per recipient."""
+        by_recipient = {}
+        for msg_data in items:
+            if msg_data.get('type') == 'batch':
+                self._send_batch(msg_data)
+            else:
+                by_recipient.setdefault(msg_data['recipient'], []).append(msg_data)
+        if not by_recipient:
+            return
+
+        if self.connection_state != ConnectionState.CONNECTED:
+            # offline - queue the messages
+            for recipient, msgs in by_recipient.items():
+                for msg_data in msgs:
+                    self.db.add_pending_message(
+                        self.user_id, recipient,
+                        msg_data['content'], msg_data['timestamp']
+                    )
+                self._adjust_pending_count(len(msgs))
+                logger.info("Queued %d offline messages to %s",
+                            len(msgs), recipient)
+            return
+
+        # these are all new messages: rows already in the pending table
+        # only come back through _send_batch
+        rows = []
+        recipients = set()
+        failed = []
+        for recipient, msgs in by_recipient.items():
+            results = self.messenger.send_many(
+                [(m['content'], recipient) for m in msgs]
+            ) if self.messenger else [False] * len(msgs)
+            for msg_data, ok in zip(msgs, results):
+                if ok:
+                    rows.append((self.username, recipient,
+                                 msg_data['content'], msg_data['timestamp']))
+                    recipients.add(recipient)
+                else:
+                    failed.append(msg_data)
+
+        if rows:
+            # one transaction for everything that went out
+            self.db.add_messages_bulk(self.user_id, rows)
+            self.incoming_queue.append({
+                'type': 'sent_success_batch',
+                'recipients': recipients
+            })
+            logger.info("Sent %d messages to %d contacts",
+                        len(rows), len(recipients))
+
+        if failed:
+            # send failed - queue for retry
+            self._handle_send_failures(failed)
+
+    def _send_batch(self, batch):
+        """send a recipient's queued messages in one write."""
+        recipient = batch['recipient']
+        items = batch['items']
+
+        if self.connection_state != ConnectionState.CONNECTED:
+            # still offline, the rows stay in pending_messages
+            return
+
+        results = self.messenger.send_many(
+            [(item['content'], recipient) for item in items]
+        ) if self.messenger else [False] * len(items)
+
+        sent = [item for item, ok in zip(items, results) if ok]
+        if sent:
+            self.db.add_messages_bulk(self.user_id, [
+                (self.username, recipient, item['content'], item['timestamp'])
+                for item in sent
+            ])
+            # overlapping flushes can send a row twice; only count the
+            # rows this one actually removed
+            removed = self.db.mark_pending_sent_bulk(
+                [item['pending_id'] for item in sent]
+            )
+            self._adjust_pending_count(-removed)
+            self.incoming_queue.append({
+                'type': 'sent_success_batch',
+                'recipients': {recipient}
+            })
+            logger.info("Sent %d queued messages to %s", len(sent), recipient)
+
+        if len(sent) < len(items):
+            # the rest are still pending, try the connection again
+            self._update_connection_state(ConnectionState.DISCONNECTED)
+            self._try_reconnect()
+
+    def _adjust_pending_count(self, delta):
+        """track messages added to / removed from the pending table."""
+        with self._pending_lock:
+            self.pending_count += delta
 
-    def _handle_send_failure(self, msg_data):
-        """handle failed message send."""
-        if not msg_data.get('is_retry'):
+    def _handle_send_failures(self, failed):
+        """handle failed message sends."""
+        for msg_data in failed:
             self.db.add_pending_message(
                 self.user_id,
                 msg_data['recipient'],
                 msg_data['content'],
                 msg_data['timestamp']
             )
+        self._adjust_pending_count(len(failed))
 
         self._update_connection_state(ConnectionState.DISCONNECTED)
         self._try_reconnect()
@@ -355,10 +487,12 @@ class MessengerApp:
         self._update_connection_state(ConnectionState.RECONNECTING)
 
         backoff = min(self.backoff_time * (2 ** self.retry_count), 60)
-        time.sleep(backoff)
+        # wakes early if the app is shutting down
+        if self.stop_event.wait(backoff):
+            return
 
         self.retry_count += 1
-        logger.info(f"Reconnection attempt {self.retry_count}")
+        logger.info("Reconnection attempt %d", self.retry_count)
 
         if self._connect():
             self._flush_pending_messages()
@@ -367,16 +501,30 @@ class MessengerApp:
         """send queued messages after reconnection."""
         pending = self.db.get_pending_messages(self.user_id)
 
+        # one batch per recipient, oldest first
+        batches = {}
         for msg in pending:
-            self.outgoing_queue.put({
-                'recipient': msg['recipient'],
+            batches.setdefault(msg['recipient'], []).append({
                 'content': msg['content'],
                 'timestamp': msg['timestamp'],
-                'is_retry': True,
                 'pending_id': msg['pending_id']
             })
 
-        logger.info(f"Flushing {len(pending)} pending messages")
+        for recipient, items in batches.items():
+            try:
+                # never block: this can run on the thread that drains
+                # the queue
+                self.outgoing_queue.put_nowait({
+                    'type': 'batch',
+                    'recipient': recipient,
+                    'items': items
+                })
+            except queue.Full:
+                # still in the pending table, picked up on the next flush
+                logger.warning("Outgoing queue full, deferring %s", recipient)
+        self.work_event.set()
+
+        logger.info("Flushing %d pending messages", len(pending))
 
     def _poll_messages(self):
         """background thread for polling new messages."""
@@ -388,64 +536,67 @@ class MessengerApp:
                         and self.messenger):
                     new_messages = self.messenger.retrieve_new()
 
+                    rows = []
+                    senders = set()
+                    received = []
+                    me = self.username
+                    now = time.time()
+                    # a poll's messages all have the same shape, so pick
+                    # the field extractor once
+                    extract = _dm_fields if new_messages and hasattr(
+                        new_messages[0], 'message') else _dict_fields
                     for msg in new_messages:
-                        # extract message data
-                        if hasattr(msg, 'message'):
-                            content = msg.message
-                            sender = msg.recipient  # 'recipient' field contains sender for received msgs
-                            timestamp = msg.timestamp
-                        else:
-                            content = msg.get('message')
-                            sender = msg.get('from')
-                            timestamp = msg.get('timestamp')
-
+                        content, sender, timestamp = extract(msg)
                         if content and sender:
-                            # save to db
-                            self.db.add_message(
-                                self.user_id, sender,
-                                self.username, content,
-                                float(timestamp) if timestamp else time.time()
-                            )
-
-                            # notify gui
-                            self.incoming_queue.put({
-                                'type': 'new_message',
-                                'sender': sender,
-                                'content': content
-                            })
-
-                time.sleep(self.config.poll_interval)
+                            rows.append((
+                                sender, me, content,
+                                to_db_time(timestamp or now)
+                            ))
+                            senders.add(sender)
+                            received.append((sender, content))
+
+                    if rows:
+                        # save the whole poll in one transaction
+                        last_id = self.db.add_messages_bulk(self.user_id, rows)
+                        first_id = last_id - len(rows) + 1
+
+                        # notify gui once per poll
+                        self.incoming_queue.append({
+                            'type': 'new_messages_batch',
+                            'senders': senders,
+                            # (sender, content, message_id)
+                            'messages': [
+                                (sender, content, first_id + i)
+                                for i, (sender, content) in enumerate(received)
+                            ]
+                        })
+
+                self.stop_event.wait(self.config.poll_interval)
 
             except Exception as e:
-                logger.error(f"Polling error: {e}")
+                logger.error("Polling error: %s", e)
                 if self.connection_state == ConnectionState.CONNECTED:
                     self._update_connection_state(ConnectionState.DISCONNECTED)
                     self._try_reconnect()
-                time.sleep(5)
+                self.stop_event.wait(5)
 
     def _process_incoming_queue(self):
         """process messages from background threads (runs in main thread)."""
-        try:
-            while True:
-                msg = self.incoming_queue.get_nowait()
-
-                if msg['type'] == 'new_message':
-                    self._refresh_contacts()
-                    if self.current_recipient == msg['sender']:
-                        self._display_messages()
-
-                elif msg['type'] == 'sent_success':
-                    if self.current_recipient == msg['recipient']:
-                        self._display_messages()
-
-        except queue.Empty:
-            pass
-
-        # update pending count
-        if self.user_id:
-            pending = self.db.get_pending_messages(self.user_id)
+        # this is the only consumer, so a non-empty deque stays non-empty
+        # until we pop from it
+        handlers = self._handlers
+        while self.incoming_queue:
+            msg = self.incoming_queue.popleft()
+            handler = handlers.get(msg['type'])
+            if handler:
+                handler(msg)
+
+        # update pending count, only when it changed since the last tick
+        pending = self.pending_count
+        if self.user_id and pending != self._shown_pending:
+            self._shown_pending = pending
             if pending:
-                self.queue_label.config(text=f"{len(pending)} queued")
+                self.queue_label.config(text=f"{pending} queued")
             else:
                 self.queue_label.config(text="")
 
@@ -453,6 +604,36 @@ class MessengerApp:
         if not self.stop_event.is_set():
             self.root.after(100, self._process_incoming_queue)
 
+    def _on_new_messages(self, msg):
+        """show messages fetched by the polling thread."""
+        self._refresh_contacts()
+        current = self.current_recipient
+        shown = []
+        for sender, content, message_id in msg['messages']:
+            entry = self._msg_cache.get((self.user_id, sender))
+            # the rows were committed before this event was queued, so a
+            # conversation loaded since then already has them
+            if entry is None or message_id <= entry[1]:
+                continue
+            entry[0].append((sender, content))
+            entry[1] = message_id
+            if sender == current:
+                shown.append((sender, content))
+        if shown:
+            # append just the new lines instead of redrawing
+            self._append_messages(shown)
+        elif (current in msg['senders']
+              and (self.user_id, current) not in self._msg_cache):
+            self._display_messages()
+
+    def _on_sent_success(self, msg):
+        """refresh conversations the network thread just sent to."""
+        # reload from the db next time they are shown
+        for recipient in msg['recipients']:
+            self._msg_cache.pop((self.user_id, recipient), None)
+        if self.current_recipient in msg['recipients']:
+            self._display_messages()
+
     def _on_contact_select(self, event=None):
         """handle contact selection."""
         selection = self.contacts_tree.selection()
@@ -468,22 +649,58 @@ class MessengerApp:
         self.messages_text.config(state='normal')
         self.messages_text.delete(1.0, tk.END)
 
-        messages = self.db.get_messages(self.user_id, self.current_recipient)
-
-        for msg in messages:
-            sender = msg['sender']
-            content = msg['content']
+        chunks = self._message_chunks(
+            self._conversation(self.current_recipient)
+        )
+        if chunks:
+            # one Tk call for the whole conversation
+            self.messages_text.insert(tk.END, *chunks)
 
-            if sender == self.username:
-                self.messages_text.insert(tk.END, "You: ", 'sent')
-                self.messages_text.insert(tk.END, f"{content}\n")
-            else:
-                self.messages_text.insert(tk.END, f"{sender}: ", 'received')
-                self.messages_text.insert(tk.END, f"{content}\n")
+        self.messages_text.config(state='disabled')
+        self.messages_text.see(tk.END)
 
+    def _conversation(self, contact):
+        """(sender, content) pairs for a conversation, from the cache or db."""
+        key = (self.user_id, contact)
+        entry = self._msg_cache.get(key)
+        if entry is not None:
+            self._msg_cache.move_to_end(key)
+            return entry[0]
+
+        rows = self.db.get_messages(self.user_id, contact)
+        messages = [(row['sender'], row['content']) for row in rows]
+        # [messages, highest message_id loaded], so polled rows that the
+        # load already picked up aren't appended again
+        self._msg_cache[key] = [
+            messages, max((row['message_id'] for row in rows), default=0)
+        ]
+        if len(self._msg_cache) > MESSAGE_CACHE_SIZE:
+            self._msg_cache.popitem(last=False)
+        return messages
+
+    def _append_messages(self, messages):
+        """add (sender, content) pairs to the end of the open conversation."""
+        chunks = self._message_chunks(messages)
+        if not chunks:
+            return
+        self.messages_text.config(state='normal')
+        self.messages_text.insert(tk.END, *chunks)
         self.messages_text.config(state='disabled')
         self.messages_text.see(tk.END)
 
+    def _message_chunks(self, messages):
+        """flatten (sender, content) pairs into Text.insert text/tag args."""
+        # hoisted out of the loop, it runs once per displayed message
+        me = self.username
+        chunks = []
+        extend = chunks.extend
+        for sender, content in messages:
+            if sender == me:
+                extend(("You: ", 'sent', f"{content}\n", ()))
+            else:
+                extend((f"{sender}: ", 'received', f"{content}\n", ()))
+        return chunks
+
     def _send_message(self):
         """queue a message for sending."""
         if not self.current_recipient:
@@ -497,17 +714,26 @@ class MessengerApp:
         msg_data = {
             'recipient': self.current_recipient,
             'content': content,
-            'timestamp': time.time()
+            'timestamp': to_db_time(time.time())
         }
 
-        self.outgoing_queue.put(msg_data)
+        try:
+            self.outgoing_queue.put_nowait(msg_data)
+            self.work_event.set()
+        except queue.Full:
+            # backlog is full - park it in the db, it is sent on the next
+            # flush after a reconnect
+            self.db.add_pending_message(
+                self.user_id, msg_data['recipient'],
+                msg_data['content'], msg_data['timestamp']
+            )
+            self._adjust_pending_count(1)
         self.message_input.delete(1.0, tk.END)
 
         # show message immediately (optimistic ui)
         self.messages_text.config(state='normal')
         tag = 'sent' if self.connection_state == ConnectionState.CONNECTED else 'queued'
-        self.messages_text.insert(tk.END, "You: ", tag)
-        self.messages_text.insert(tk.END, f"{content}\n")
+        self.messages_text.insert(tk.END, "You: ", tag, f"{content}\n", ())
         self.messages_text.config(state='disabled')
         self.messages_text.see(tk.END)
 
@@ -532,11 +758,20 @@ class MessengerApp:
         if not self.user_id:
             return
 
-        self.contacts_tree.delete(*self.contacts_tree.get_children())
+        # only touch the rows that changed, so the tree (and its selection)
+        # isn't rebuilt for every poll that brings in a message
         contacts = self.db.get_contacts(self.user_id)
-
-        for contact in contacts:
-            self.contacts_tree.insert('', 'end', text=contact)
+        shown = self._contact_iids
+        removed = shown.keys() - set(contacts)
+        if removed:
+            self.contacts_tree.delete(*(shown.pop(c) for c in removed))
+
+        # get_contacts is sorted, so new rows go in at their list position
+        for index, contact in enumerate(contacts):
+            if contact not in shown:
+                shown[contact] = self.contacts_tree.insert(
+                    '', index, text=contact
+                )
 
     def shutdown(self):
         """graceful shutdown."""
@@ -544,6 +779,7 @@ class MessengerApp:
 
         # signal threads to stop
         self.stop_event.set()
+        self.work_event.set()
 
         # wait for threads
         if self.network_thread and self.network_thread.is_alive():
@@ -555,6 +791,8 @@ class MessengerApp:
         if self.messenger:
             self.messenger.close()
 
+        self.db.close()
+
         logger.info("Shutdown complete")
         self.root.destroy()
 
@@ -1,7 +1,9 @@
 # security.py
 """Password hashing utilities for secure credential storage."""
 
+import base64
 import hashlib
+import hmac
 import os
 
 # try to use bcrypt if available, otherwise use pbkdf2
@@ -11,50 +13,151 @@ try:
 except ImportError:
     HAS_BCRYPT = False
 
+# hashlib.scrypt needs python built against openssl 1.1+
+HAS_SCRYPT = hasattr(hashlib, 'scrypt')
+
+PBKDF2_ITERATIONS = 100000
+PBKDF2_PREFIX = 'pbkdf2$'
+LEGACY_PBKDF2_PREFIX = 'pbkdf2:'
+
+# scrypt cost: n=2**14, r=8 uses 16MB per hash
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_PREFIX = 'scrypt$'
 
-def hash_password(password: str) -> str:
-    """hash a password securely.
 
-    uses bcrypt if available, otherwise falls back to pbkdf2.
+def _hash_bcrypt(password: str) -> str:
+    """hash with bcrypt."""
+    return bcrypt.hashpw(
+        password.encode('utf-8'),
+        bcrypt.gensalt()
+    ).decode('utf-8')
+
+
+def _hash_pbkdf2(password: str) -> str:
+    """hash with pbkdf2-sha256.
+
+    format: pbkdf2$sha256$<iterations>$<salt_b64>$<key_b64>
     """
-    if HAS_BCRYPT:
-        return bcrypt.hashpw(
+    salt = os.urandom(16)
+    key = hashlib.pbkdf2_hmac(
+        'sha256',
+        password.encode('utf-8'),
+        salt,
+        PBKDF2_ITERATIONS
+    )
+    return (f"{PBKDF2_PREFIX}sha256${PBKDF2_ITERATIONS}$"
+            f"{base64.b64encode(salt).decode('ascii')}$"
+            f"{base64.b64encode(key).decode('ascii')}")
+
+
+def _hash_scrypt(password: str) -> str:
+    """hash with scrypt.
+
+    format: scrypt$<n>$<r>$<p>$<salt_b64>$<key_b64>
+    """
+    salt = os.urandom(16)
+    key = hashlib.scrypt(
+        password.encode('utf-8'),
+        salt=salt,
+        n=SCRYPT_N,
+        r=SCRYPT_R,
+        p=SCRYPT_P
+    )
+    return (f"{SCRYPT_PREFIX}{SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$"
+            f"{base64.b64encode(salt).decode('ascii')}$"
+            f"{base64.b64encode(key).decode('ascii')}")
+
+
+def _verify_scrypt(password: str, hashed: str) -> bool:
+    """check a password against a scrypt$ hash."""
+    parts = hashed.split('$', 5)
+    if len(parts) != 6 or not HAS_SCRYPT:
+        return False
+    _, n, r, p, salt, stored_key = parts
+    try:
+        stored_key = base64.b64decode(stored_key)
+        key = hashlib.scrypt(
             password.encode('utf-8'),
-            bcrypt.gensalt()
-        ).decode('utf-8')
-    else:
-        # fallback to pbkdf2
-        salt = os.urandom(16)
+            salt=base64.b64decode(salt),
+            n=int(n),
+            r=int(r),
+            p=int(p),
+            dklen=len(stored_key)
+        )
+    except ValueError:
+        return False
+    return hmac.compare_digest(key, stored_key)
+
+
+def _verify_pbkdf2(password: str, hashed: str) -> bool:
+    """check a password against a pbkdf2$ hash."""
+    parts = hashed.split('$', 4)
+    if len(parts) != 5:
+        return False
+    _, algorithm, iterations, salt, stored_key = parts
+    try:
+        salt = base64.b64decode(salt)
+        stored_key = base64.b64decode(stored_key)
         key = hashlib.pbkdf2_hmac(
-            'sha256',
+            algorithm,
             password.encode('utf-8'),
             salt,
-            100000
+            int(iterations)
         )
-        return f"pbkdf2:{salt.hex()}:{key.hex()}"
+    except ValueError:
+        return False
+    return hmac.compare_digest(key, stored_key)
+
+
+def _verify_legacy_pbkdf2(password: str, hashed: str) -> bool:
+    """check a password against an older pbkdf2:salt_hex:key_hex hash."""
+    parts = hashed.split(':')
+    if len(parts) != 3:
+        return False
+    salt = bytes.fromhex(parts[1])
+    stored_key = bytes.fromhex(parts[2])
+    key = hashlib.pbkdf2_hmac(
+        'sha256',
+        password.encode('utf-8'),
+        salt,
+        100000
+    )
+    return hmac.compare_digest(key, stored_key)
+
+
+# the backend is picked once here rather than on every call:
+# bcrypt, then scrypt, then pbkdf2
+if HAS_BCRYPT:
+    _hash = _hash_bcrypt
+elif HAS_SCRYPT:
+    _hash = _hash_scrypt
+else:
+    _hash = _hash_pbkdf2
+
+
+def hash_password(password: str) -> str:
+    """hash a password securely.
+
+    uses bcrypt if available, otherwise scrypt, otherwise pbkdf2.
+    """
+    return _hash(password)
 
 
 def verify_password(password: str, hashed: str) -> bool:
     """verify a password against its hash."""
-    if HAS_BCRYPT and not hashed.startswith('pbkdf2:'):
+    if hashed.startswith(SCRYPT_PREFIX):
+        return _verify_scrypt(password, hashed)
+    if hashed.startswith(PBKDF2_PREFIX):
+        return _verify_pbkdf2(password, hashed)
+    if hashed.startswith(LEGACY_PBKDF2_PREFIX):
+        return _verify_legacy_pbkdf2(password, hashed)
+    if HAS_BCRYPT:
         return bcrypt.checkpw(
             password.encode('utf-8'),
             hashed.encode('utf-8')
         )
-    elif hashed.startswith('pbkdf2:'):
-        # pbkdf2 format: pbkdf2:salt_hex:key_hex
-        parts = hashed.split(':')
-        if len(parts) != 3:
-            return False
-        salt = bytes.fromhex(parts[1])
-        stored_key = bytes.fromhex(parts[2])
-        key = hashlib.pbkdf2_hmac(
-            'sha256',
-            password.encode('utf-8'),
-            salt,
-            100000
-        )
-        return key == stored_key
-    else:
-        # plain text comparison for legacy data
-        return password == hashed
+    # plain text comparison for legacy data
+    return hmac.compare_digest(password.encode('utf-8'),
+                               hashed.encode('utf-8'))
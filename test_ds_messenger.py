@@ -1,12 +1,75 @@
 # test_ds_messenger.py
 """Test module for the DS Messenger functionality.."""
 
+import logging
+import re
 import time
 import unittest
 import socket
 import json
-from unittest.mock import patch, MagicMock, mock_open
-from ds_messenger import DirectMessenger, DirectMessage
+from contextlib import nullcontext
+from unittest.mock import patch, MagicMock
+from ds_messenger import DirectMessenger, DirectMessage, HAS_IJSON
+from ds_messenger import DirectMessengerPool
+from testsupport import TEST_USER1, TEST_USER2, needs_server
+
+logger = logging.getLogger(__name__)
+
+# failures the client is expected to swallow and report as a failed call
+ERRORS = (ConnectionError, socket.error, Exception)
+
+
+def _wait_for_message(fetch, expected, timeout=1.0):
+    """Poll fetch() until it returns a message with the expected text
+
+    Returns the last batch fetched, which is what the caller asserts on if
+    the message never shows up before the timeout."""
+    deadline = time.monotonic() + timeout
+    while True:
+        messages = fetch()
+        if (any(m.message == expected for m in messages)
+                or time.monotonic() >= deadline):
+            return messages
+        time.sleep(0.01)
+
+
+def _reply(**response):
+    """A server reply line, as it comes off the socket"""
+    return (json.dumps({"response": response}) + "\r\n").encode('utf-8')
+
+
+# the exact request lines the client should write for "test_token"
+UNREAD_REQUEST = b'{"token":"test_token","directmessage":"new"}\r\n'
+ALL_REQUEST = b'{"token":"test_token","directmessage":"all"}\r\n'
+# a direct message line; the timestamp is taken at send time
+DM_REQUEST_RE = re.compile(
+    rb'\{"token":"test_token","directmessage":\{"entry":"[^"]*",'
+    rb'"recipient":"[^"]*","timestamp":"\d+\.\d{9}"\}\}\r\n')
+
+# canned server replies, encoded once for every test that uses them
+OK_SEND = _reply(type="ok", message="Direct message sent")
+ERROR_SEND = _reply(type="error", message="Error sending message")
+ERROR_AUTH = _reply(type="error", message="Invalid credentials")
+ERROR_RETRIEVE = _reply(type="error", message="Error retrieving messages")
+NEW_MESSAGES = _reply(type="ok", messages=[
+    {"message": "Test message", "from": "sender", "timestamp": "1234567890"},
+])
+ALL_MESSAGES = _reply(type="ok", messages=[
+    {"message": "Incoming", "from": "sender", "timestamp": "1234567890"},
+    {"message": "Outgoing", "recipient": "recipient",
+     "timestamp": "1234567891"},
+])
+# the same replies decoded, keyed by the line the parser is handed
+DECODED_REPLIES = {
+    reply.rstrip(): json.loads(reply)
+    for reply in (OK_SEND, ERROR_SEND, ERROR_AUTH, ERROR_RETRIEVE,
+                  NEW_MESSAGES, ALL_MESSAGES)
+}
+
+
+def _prehydrated_loads(data):
+    """Stand-in for jsonutil.loads that looks up a canned reply"""
+    return DECODED_REPLIES[bytes(data).rstrip()]
 
 
 class TestDirectMessage(unittest.TestCase):
@@ -20,6 +83,11 @@ class TestDirectMessage(unittest.TestCase):
         self.assertIsNone(dm.recipient)
         self.assertIsNone(dm.message)
         self.assertIsNone(dm.timestamp)
+        
+        dm = DirectMessage("recipient", "Test message", "1234567890")
+        self.assertEqual(dm.recipient, "recipient")
+        self.assertEqual(dm.message, "Test message")
+        self.assertEqual(dm.timestamp, "1234567890")
     
     def test_is_valid(self):
         """the is_valid method"""
@@ -38,36 +106,60 @@ class TestDirectMessage(unittest.TestCase):
         dm.message = None
         self.assertFalse(dm.is_valid())
 
+    def test_direct_message_has_slots(self):
+        """DirectMessage keeps its fields in slots, not a per-instance dict"""
+        self.assertEqual(DirectMessage.__slots__,
+                         ('recipient', 'message', 'timestamp'))
+        dm = DirectMessage()
+        self.assertFalse(hasattr(dm, '__dict__'))
+        with self.assertRaises(AttributeError):
+            dm.new_field = 1
+
 
 class TestDirectMessenger(unittest.TestCase):
     """Test cases for the DirectMessenger class."""
 
+    @classmethod
+    def setUpClass(cls):
+        # one messenger for all the mock-socket tests, see _mock_messenger
+        cls.mock_messenger = DirectMessenger()
+
     def setUp(self):
         """Setting up the test info"""
-        # creating the usernames for tests
-        timestamp = str(int(time.time()))
-        self.test_user1 = {
-            'username': f'testuser1_{timestamp}',
-            'password': 'testpass1'
-        }
-        self.test_user2 = {
-            'username': f'testuser2_{timestamp}',
-            'password': 'testpass2'
-        }
-
-        print("\nCreating test users:")
-        print(f"User1: {self.test_user1['username']}")
-        print(f"User2: {self.test_user2['username']}")
-
-        # create messenger instances
-        self.messenger1 = DirectMessenger(
-            username=self.test_user1['username'],
-            password=self.test_user1['password']
-        )
-        self.messenger2 = DirectMessenger(
-            username=self.test_user2['username'],
-            password=self.test_user2['password']
-        )
+        # mock sockets can't go through select(), report them as idle
+        select_patcher = patch('ds_messenger.select.select',
+                               return_value=([], [], []))
+        select_patcher.start()
+        self.addCleanup(select_patcher.stop)
+        # ...and make them write through sendall
+        sendmsg_patcher = patch('ds_messenger._HAS_SENDMSG', False)
+        sendmsg_patcher.start()
+        self.addCleanup(sendmsg_patcher.stop)
+
+    def _mock_messenger(self, sock=None):
+        """A logged-in messenger talking to sock (a mock socket by default)
+
+        The class's messenger is reused; everything a test can leave behind
+        on it is reset here."""
+        if sock is None:
+            sock = MagicMock(spec=socket.socket)
+        messenger = self.mock_messenger
+        messenger.token = "test_token"
+        messenger.socket = sock
+        messenger._rxbuf.clear()
+        messenger._pipeline.clear()
+        messenger._reader = None
+        return messenger, sock
+
+    def _parse_modes(self):
+        """(mode, context) pairs to run a reply-handling test under: once
+        with the canned reply decoded from its JSON, once with the decoder
+        swapped for a lookup of the already-decoded replies, which checks
+        (and lets a profiler time) the protocol handling apart from JSON
+        parsing"""
+        return (("json", nullcontext()),
+                ("prehydrated", patch('ds_protocol.jsonutil.loads',
+                                      _prehydrated_loads)))
 
     def test_init(self):
         """Test DirectMessenger"""
@@ -82,8 +174,7 @@ class TestDirectMessenger(unittest.TestCase):
         self.assertEqual(messenger.password, "testpass")
         self.assertEqual(messenger.port, 3001)
         self.assertIsNone(messenger.socket)
-        self.assertIsNone(messenger.send_stream)
-        self.assertIsNone(messenger.recv_stream)
+        self.assertEqual(messenger._rxbuf, b'')
         
         # test with default server
         messenger = DirectMessenger(
@@ -95,12 +186,8 @@ class TestDirectMessenger(unittest.TestCase):
     def test_connect_authentication_failure(self):
         """connect method with auth failure"""
         with patch('socket.socket') as mock_socket:
-            mock_recv = MagicMock()
-            mock_send = MagicMock()
-            
             # set up the mock to return an error response
-            mock_recv.readline.return_value = '{"response": {"type": "error", "message": "Invalid credentials"}}'
-            mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
+            mock_socket.return_value.recv.return_value = ERROR_AUTH
             
             messenger = DirectMessenger(
                 username="testuser",
@@ -110,49 +197,39 @@ class TestDirectMessenger(unittest.TestCase):
             self.assertFalse(result)
             self.assertIsNone(messenger.token)
 
-    def test_connect_connection_error(self):
-        """connect method - ConnectionError"""
-        with patch('socket.socket') as mock_socket:
-            mock_socket.return_value.connect.side_effect = ConnectionError("Connection error")
-            
-            messenger = DirectMessenger(
-                username="testuser",
-                password="testpass"
-            )
-            result = messenger.connect()
-            self.assertFalse(result)
-            
-    def test_connect_socket_error(self):
-        """connect method handling a socket.error"""
-        with patch('socket.socket') as mock_socket:
-            mock_socket.return_value.connect.side_effect = socket.error("Socket error")
-            
-            messenger = DirectMessenger(
-                username="testuser",
-                password="testpass"
-            )
-            result = messenger.connect()
-            self.assertFalse(result)
-    
-    def test_connect_general_exception(self):
-        """connect method handling (general) exceptions"""
-        with patch('socket.socket') as mock_socket:
-            mock_socket.return_value.connect.side_effect = Exception("General error")
-            
-            messenger = DirectMessenger(
-                username="testuser",
-                password="testpass"
-            )
-            result = messenger.connect()
-            self.assertFalse(result)
+    def test_connect_auth_timeout(self):
+        """connect gives up on a server that never answers the join"""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        
+        messenger = DirectMessenger(username="testuser", password="testpass")
+        messenger.port = listener.getsockname()[1]
+        messenger.auth_timeout = 0.2
+        
+        start = time.monotonic()
+        self.assertFalse(messenger.connect())
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIsNone(messenger.token)
+
+    def test_connect_errors(self):
+        """connect method - ConnectionError, socket.error and general exceptions"""
+        for exc in ERRORS:
+            with self.subTest(exc=exc.__name__), \
+                    patch('socket.socket') as mock_socket:
+                mock_socket.return_value.connect.side_effect = exc("Connection error")
+                
+                messenger = DirectMessenger(
+                    username="testuser",
+                    password="testpass"
+                )
+                result = messenger.connect()
+                self.assertFalse(result)
     
     def test_connect_without_credentials(self):
         """connect method without any creds."""
         with patch('socket.socket') as mock_socket:
-            mock_recv = MagicMock()
-            mock_send = MagicMock()
-            mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-            
             messenger = DirectMessenger()
             result = messenger.connect()
             self.assertFalse(result)
@@ -177,319 +254,269 @@ class TestDirectMessenger(unittest.TestCase):
             result = messenger.send("Test message", "recipient")
             self.assertFalse(result)
 
-    @patch('socket.socket')
-    def test_send_with_token(self, mock_socket):
+    def test_send_with_token(self):
         """Test send method with a token"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_recv.readline.return_value = '{"response": {"type": "ok", "message": "Direct message sent"}}'
+        for mode, parsing in self._parse_modes():
+            with self.subTest(mode=mode), parsing:
+                messenger, sock = self._mock_messenger()
+                sock.recv.return_value = OK_SEND
         
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        result = messenger.send("Test message", "recipient")
-        self.assertTrue(result)
+                result = messenger.send("Test message", "recipient")
+                self.assertTrue(result)
         
-        mock_send.write.assert_called_once()
-        mock_send.flush.assert_called_once()
+                sock.sendall.assert_called_once()
+                self.assertRegex(sock.sendall.call_args[0][0], DM_REQUEST_RE)
     
-    @patch('socket.socket')
-    def test_send_error_response(self, mock_socket):
-        """Test send method with error response"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_recv.readline.return_value = '{"response": {"type": "error", "message": "Error sending message"}}'
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        result = messenger.send("Test message", "recipient")
-        self.assertFalse(result)
-    
-    @patch('socket.socket')
-    def test_send_connection_error(self, mock_socket):
-        """Test send method for ConnectionError"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_send.write.side_effect = ConnectionError("Connection error")
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        result = messenger.send("Test message", "recipient")
-        self.assertFalse(result)
+    def test_send_many(self):
+        """send_many writes every message at once and reads each reply"""
+        messenger, sock = self._mock_messenger()
+        sock.recv.return_value = OK_SEND + ERROR_SEND
+        
+        results = messenger.send_many([("one", "alice"), ("two", "bob")])
+        self.assertEqual(results, [True, False])
+        
+        sock.sendall.assert_called_once()
+        payload = sock.sendall.call_args[0][0]
+        self.assertEqual(len(DM_REQUEST_RE.findall(payload)), 2)
+        self.assertEqual(messenger.send_many([]), [])
     
-    @patch('socket.socket')
-    def test_send_socket_error(self, mock_socket):
-        """Test send method for socket.error"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_send.write.side_effect = socket.error("Socket error")
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
+    def test_send_async(self):
+        """pipelined sends resolve in order from replies read later"""
+        client, server = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        messenger, _ = self._mock_messenger(client)
+        
+        futures = [messenger.send_async(f"message {i}", "recipient")
+                   for i in range(3)]
+        server.sendall(OK_SEND + ERROR_SEND + OK_SEND)
+        
+        results = [future.result(timeout=5) for future in futures]
+        self.assertEqual(results, [True, False, True])
+        messenger._wait_pipeline()
+        self.assertIsNone(messenger._reader)
+        
+        # the socket can be used synchronously again
+        server.sendall(OK_SEND)
+        self.assertTrue(messenger.send("after", "recipient"))
+
+    def test_send_async_cancelled(self):
+        """a cancelled future is skipped and the reader carries on"""
+        client, server = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        messenger, _ = self._mock_messenger(client)
+
+        futures = [messenger.send_async(f"message {i}", "recipient")
+                   for i in range(2)]
+        self.assertTrue(futures[0].cancel())
+        server.sendall(OK_SEND + OK_SEND)
+
+        self.assertTrue(futures[1].result(timeout=5))
+        messenger._wait_pipeline()
+        self.assertIsNone(messenger._reader)
+
+    def test_send_async_reply_timeout(self):
+        """a server that stops replying fails the pipeline, not the caller"""
+        client, server = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        messenger, _ = self._mock_messenger(client)
+
+        with patch.object(messenger, 'reply_timeout', 0.1):
+            future = messenger.send_async("message", "recipient")
+            reader = messenger._reader
+            messenger._wait_pipeline()
+        self.assertFalse(future.result(timeout=0))
+        self.assertIsNone(messenger._reader)
+        self.assertIsNone(messenger.token)
+        # the abandoned reader notices and exits
+        reader.join(timeout=2)
+        self.assertFalse(reader.is_alive())
+
+    def test_send_error_response(self):
+        """Test send method with error response"""
+        for mode, parsing in self._parse_modes():
+            with self.subTest(mode=mode), parsing:
+                messenger, sock = self._mock_messenger()
+                sock.recv.return_value = ERROR_SEND
         
-        result = messenger.send("Test message", "recipient")
-        self.assertFalse(result)
+                result = messenger.send("Test message", "recipient")
+                self.assertFalse(result)
     
-    @patch('socket.socket')
-    def test_send_general_exception(self, mock_socket):
-        """Test send method for (general) exceptions"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_send.write.side_effect = Exception("General error")
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        result = messenger.send("Test message", "recipient")
-        self.assertFalse(result)
+    def test_send_errors(self):
+        """Test send method for ConnectionError, socket.error and (general) exceptions"""
+        messenger, sock = self._mock_messenger()
+        for exc in ERRORS:
+            with self.subTest(exc=exc.__name__):
+                sock.sendall.side_effect = exc("Send error")
+                
+                result = messenger.send("Test message", "recipient")
+                self.assertFalse(result)
             
-    @patch('socket.socket')
-    def test_retrieve_new_messages(self, mock_socket):
+    def test_retrieve_new_messages_mock(self):
         """Test retrieving naynew messages"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_recv.readline.return_value = (
-            '{"response": {"type": "ok", "messages": ['
-            '{"message": "Test message", "from": "sender", "timestamp": "1234567890"}'
-            ']}}'
-        )
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        messages = messenger.retrieve_new()
-        self.assertEqual(len(messages), 1)
-        self.assertEqual(messages[0].message, "Test message")
-        self.assertEqual(messages[0].recipient, "sender")
-        self.assertEqual(messages[0].timestamp, "1234567890")
-        
-        mock_send.write.assert_called_once()
-        mock_send.flush.assert_called_once()
+        for mode, parsing in self._parse_modes():
+            with self.subTest(mode=mode), parsing:
+                messenger, sock = self._mock_messenger()
+                sock.recv.return_value = NEW_MESSAGES
+        
+                messages = messenger.retrieve_new()
+                self.assertEqual(len(messages), 1)
+                self.assertEqual(messages[0].message, "Test message")
+                self.assertEqual(messages[0].recipient, "sender")
+                self.assertEqual(messages[0].timestamp, "1234567890")
+        
+                sock.sendall.assert_called_once_with(UNREAD_REQUEST)
     
-    @patch('socket.socket')
-    def test_retrieve_new_messages_error_response(self, mock_socket):
+    def test_retrieve_new_messages_error_response(self):
         """Test retrieving new messages w/ error response"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_recv.readline.return_value = '{"response": {"type": "error", "message": "Error retrieving messages"}}'
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        messages = messenger.retrieve_new()
-        self.assertEqual(len(messages), 0)
-
-    @patch('socket.socket')
-    def test_retrieve_new_connection_error(self, mock_socket):
-        """Test retrieving new messages ConnectionError"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_send.write.side_effect = ConnectionError("Connection error")
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        messages = messenger.retrieve_new()
-        self.assertEqual(len(messages), 0)
-    
-    @patch('socket.socket')
-    def test_retrieve_new_socket_error(self, mock_socket):
-        """Test retrieving new messages for socket.error"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_send.write.side_effect = socket.error("Socket error")
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        messages = messenger.retrieve_new()
-        self.assertEqual(len(messages), 0)
-    
-    @patch('socket.socket')
-    def test_retrieve_new_general_exception(self, mock_socket):
-        """Test retrieving new messages for any genealexceptions"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_send.write.side_effect = Exception("General error")
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        messages = messenger.retrieve_new()
-        self.assertEqual(len(messages), 0)
-
-    @patch('socket.socket')
-    def test_retrieve_all_messages(self, mock_socket):
+        for mode, parsing in self._parse_modes():
+            with self.subTest(mode=mode), parsing:
+                messenger, sock = self._mock_messenger()
+                sock.recv.return_value = ERROR_RETRIEVE
+        
+                messages = messenger.retrieve_new()
+                self.assertEqual(len(messages), 0)
+
+    def test_retrieve_new_errors(self):
+        """Test retrieving new messages for ConnectionError, socket.error and general exceptions"""
+        messenger, sock = self._mock_messenger()
+        for exc in ERRORS:
+            with self.subTest(exc=exc.__name__):
+                sock.sendall.side_effect = exc("Retrieve error")
+                
+                messages = messenger.retrieve_new()
+                self.assertEqual(len(messages), 0)
+
+    def test_retrieve_all_messages_mock(self):
         """Test retrieving all messages.."""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_recv.readline.return_value = (
-            '{"response": {"type": "ok", "messages": ['
-            '{"message": "Incoming", "from": "sender", "timestamp": "1234567890"},'
-            '{"message": "Outgoing", "recipient": "recipient", "timestamp": "1234567891"}'
-            ']}}'
-        )
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        messages = messenger.retrieve_all()
-        self.assertEqual(len(messages), 2)
-        # check the first message (received)
-        self.assertEqual(messages[0].message, "Incoming")
-        self.assertEqual(messages[0].recipient, "sender")
-        self.assertEqual(messages[0].timestamp, "1234567890")
-        # check the second message (sent)
-        self.assertEqual(messages[1].message, "Outgoing")
-        self.assertEqual(messages[1].recipient, "recipient")
-        self.assertEqual(messages[1].timestamp, "1234567891")
-        
-        mock_send.write.assert_called_once()
-        mock_send.flush.assert_called_once()
+        for mode, parsing in self._parse_modes():
+            with self.subTest(mode=mode), parsing:
+                messenger, sock = self._mock_messenger()
+                sock.recv.return_value = ALL_MESSAGES
+        
+                messages = messenger.retrieve_all()
+                self.assertEqual(len(messages), 2)
+                # check the first message (received)
+                self.assertEqual(messages[0].message, "Incoming")
+                self.assertEqual(messages[0].recipient, "sender")
+                self.assertEqual(messages[0].timestamp, "1234567890")
+                # check the second message (sent)
+                self.assertEqual(messages[1].message, "Outgoing")
+                self.assertEqual(messages[1].recipient, "recipient")
+                self.assertEqual(messages[1].timestamp, "1234567891")
+        
+                sock.sendall.assert_called_once_with(ALL_REQUEST)
     
-    @patch('socket.socket')
-    def test_retrieve_all_messages_error_response(self, mock_socket):
+    def test_retrieve_all_messages_error_response(self):
         """Test retrieving all messages with an error response"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_recv.readline.return_value = '{"response": {"type": "error", "message": "Error retrieving messages"}}'
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        messages = messenger.retrieve_all()
-        self.assertEqual(len(messages), 0)
-    
-    @patch('socket.socket')
-    def test_retrieve_all_connection_error(self, mock_socket):
-        """Test retrieving all messages -- ConnectionError"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_send.write.side_effect = ConnectionError("Connection error")
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
+        for mode, parsing in self._parse_modes():
+            with self.subTest(mode=mode), parsing:
+                messenger, sock = self._mock_messenger()
+                sock.recv.return_value = ERROR_RETRIEVE
         
-        messages = messenger.retrieve_all()
-        self.assertEqual(len(messages), 0)
+                messages = messenger.retrieve_all()
+                self.assertEqual(len(messages), 0)
     
-    @patch('socket.socket')
-    def test_retrieve_all_socket_error(self, mock_socket):
-        """Test retrieving all messages -- socket.error"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_send.write.side_effect = socket.error("Socket error")
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
+    def test_retrieve_all_errors(self):
+        """Test retrieving all messages -- ConnectionError, socket.error and general exceptions"""
+        messenger, sock = self._mock_messenger()
+        for exc in ERRORS:
+            with self.subTest(exc=exc.__name__):
+                sock.sendall.side_effect = exc("Retrieve error")
+                
+                messages = messenger.retrieve_all()
+                self.assertEqual(len(messages), 0)
+
+    def test_readline_bytes_buffering(self):
+        """lines split across (and packed into) recv chunks"""
+        mock_socket = MagicMock(spec=socket.socket)
+        mock_socket.recv.side_effect = [b'{"a": ', b'1}\r\n{"b"', b': 2}\r\n', b'']
         
         messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        messages = messenger.retrieve_all()
-        self.assertEqual(len(messages), 0)
-    
-    @patch('socket.socket')
-    def test_retrieve_all_general_exception(self, mock_socket):
-        """Test retrieving all messages just with general exceptions"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_send.write.side_effect = Exception("General error")
+        messenger.socket = mock_socket
         
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
+        self.assertEqual(messenger._readline_bytes(), b'{"a": 1}\r')
+        self.assertEqual(messenger._readline_bytes(), b'{"b": 2}\r')
+        # server closed the connection
+        with self.assertRaises(ConnectionError):
+            messenger._readline_bytes()
+
+    def test_send_line_sendmsg(self):
+        """a line and its terminator go out in one sendmsg call"""
+        client, server = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
         
         messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        messages = messenger.retrieve_all()
-        self.assertEqual(len(messages), 0)
+        messenger.socket = client
+        with patch('ds_messenger._HAS_SENDMSG', True):
+            messenger._send_line('{"a": 1}')
+        self.assertEqual(server.recv(100), b'{"a": 1}\r\n')
+        
+        # a partial write is finished with sendall
+        mock_socket = MagicMock(spec=socket.socket)
+        mock_socket.sendmsg.return_value = 3
+        messenger.socket = mock_socket
+        with patch('ds_messenger._HAS_SENDMSG', True):
+            messenger._send_line('{"a": 1}')
+        mock_socket.sendall.assert_called_once_with(b'": 1}\r\n')
+
+    @unittest.skipUnless(HAS_IJSON, "ijson not installed")
+    def test_iter_all_streaming(self):
+        """messages are streamed and the rest of the reply is consumed"""
+        client, server = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        messenger, _ = self._mock_messenger(client)
+        
+        server.sendall(b'{"response": {"type": "ok", "messages": ['
+                       b'{"message": "hi", "from": "alice", "timestamp": 1.5},')
+        server.sendall(b'{"message": "yo", "recipient": "bob", '
+                       b'"timestamp": 2.5}]}}\r\n{"next": 1}\r\n')
+        
+        stream = messenger.iter_all()
+        first = next(stream)
+        self.assertEqual((first.recipient, first.message, first.timestamp),
+                         ("alice", "hi", 1.5))
+        # stopping early still leaves the socket at the next reply
+        stream.close()
+        self.assertEqual(messenger._readline_bytes(), b'{"next": 1}\r')
+
+    def test_pool(self):
+        """the pool connects every messenger and hands out idle ones"""
+        with patch.object(DirectMessenger, 'connect',
+                          return_value=True) as mock_connect:
+            pool = DirectMessengerPool(username="u", password="p", size=3)
+        self.assertEqual(mock_connect.call_count, 3)
+        
+        with patch.object(DirectMessenger, 'send',
+                          return_value=True) as mock_send:
+            self.assertTrue(pool.send("hi", "alice"))
+            mock_send.assert_called_once_with("hi", "alice")
+        self.assertEqual(pool._idle.qsize(), 3)
+        
+        with patch.object(DirectMessenger, 'close') as mock_close:
+            pool.close()
+        self.assertEqual(mock_close.call_count, 3)
+
+    def test_ensure_connected(self):
+        """an idle socket is reused, one closed by the server is replaced"""
+        messenger, mock_socket = self._mock_messenger()
+        
+        with patch.object(DirectMessenger, 'connect') as mock_connect:
+            self.assertTrue(messenger._ensure_connected())
+            mock_connect.assert_not_called()
+            
+            # readable with nothing to read means EOF
+            mock_socket.recv.return_value = b''
+            with patch('ds_messenger.select.select',
+                       return_value=([mock_socket], [], [])):
+                messenger._ensure_connected()
+            mock_socket.close.assert_called_once()
+            mock_connect.assert_called_once()
+            self.assertIsNone(messenger.token)
 
     def test_retrieve_without_token(self):
         """Test retrieving messages without a token"""
@@ -505,165 +532,138 @@ class TestDirectMessenger(unittest.TestCase):
             messages = messenger.retrieve_all()
             self.assertEqual(len(messages), 0)
 
-    @patch('socket.socket')
-    def test_retrieve_messages_error_handling(self, mock_socket):
+    def test_retrieve_messages_error_handling(self):
         """Test error handling in the retrieve methods"""
-        mock_recv = MagicMock()
-        mock_send = MagicMock()
-        
-        mock_recv.readline.side_effect = ConnectionError("Connection lost")
-        
-        mock_socket.return_value.makefile.side_effect = [mock_recv, mock_send]
-        
-        messenger = DirectMessenger()
-        messenger.token = "test_token"
-        messenger.socket = mock_socket.return_value
-        messenger.recv_stream = mock_recv
-        messenger.send_stream = mock_send
-        
-        # test retrieve_new error handling
-        messages = messenger.retrieve_new()
-        self.assertEqual(len(messages), 0)
-        
-        # reset the mock
-        mock_recv.readline.side_effect = ConnectionError("Connection lost")
-        
-        # test retrieve_all error handling
-        messages = messenger.retrieve_all()
-        self.assertEqual(len(messages), 0)
+        for method in ("retrieve_new", "retrieve_all"):
+            with self.subTest(method=method):
+                messenger, sock = self._mock_messenger()
+                sock.recv.side_effect = ConnectionError("Connection lost")
+                
+                messages = getattr(messenger, method)()
+                self.assertEqual(len(messages), 0)
 
     def test_close(self):
         """Test the close method"""
-        mock_socket = MagicMock()
-        mock_send = MagicMock()
-        mock_recv = MagicMock()
+        mock_socket = MagicMock(spec=socket.socket)
         
         messenger = DirectMessenger()
         messenger.socket = mock_socket
-        messenger.send_stream = mock_send
-        messenger.recv_stream = mock_recv
         
         messenger.close()
         
-        mock_send.close.assert_called_once()
-        mock_recv.close.assert_called_once()
         mock_socket.close.assert_called_once()
         
         # test exception handling
-        mock_send.close.side_effect = Exception("Error closing stream")
+        mock_socket.close.side_effect = Exception("Error closing socket")
         messenger.close()  # Should not raise an exception
 
     def test_close_with_exception(self):
         """Test close method with some exception handling"""
-        mock_socket = MagicMock()
-        mock_send = MagicMock()
-        mock_recv = MagicMock()
+        mock_socket = MagicMock(spec=socket.socket)
         
-        # set up the mocks to raise exceptions
-        mock_send.close.side_effect = Exception("Error closing send stream")
-        mock_recv.close.side_effect = Exception("Error closing recv stream")
+        # set up the mock to raise an exception
         mock_socket.close.side_effect = Exception("Error closing socket")
         
         messenger = DirectMessenger()
         messenger.socket = mock_socket
-        messenger.send_stream = mock_send
-        messenger.recv_stream = mock_recv
         
         # this should NOT raise an exception
         messenger.close()
 
+
+# the mock-socket tests above share no state and can be spread across
+# processes; these talk to the one server and are kept apart so they
+# can be selected (or deselected) as a group
+@needs_server
+class TestDirectMessengerServer(unittest.TestCase):
+    """Tests for the DirectMessenger class against a running server."""
+
+    def _live_messengers(self):
+        """Set up the two users and messengers the integration tests share"""
+        self.test_user1 = TEST_USER1
+        self.test_user2 = TEST_USER2
+
+        # create messenger instances
+        self.messenger1 = DirectMessenger(
+            username=self.test_user1['username'],
+            password=self.test_user1['password']
+        )
+        self.addCleanup(self.messenger1.close)
+        self.messenger2 = DirectMessenger(
+            username=self.test_user2['username'],
+            password=self.test_user2['password']
+        )
+        self.addCleanup(self.messenger2.close)
+
     def test_connection(self):
         """Test connection to server"""
-        try:
-            print("\nTesting connection...")
-            result = self.messenger1.connect()
-            if not result:
-                print(f"Connection failed for {self.test_user1['username']}")
-            self.assertTrue(result)
-            self.assertIsNotNone(self.messenger1.token)
-        except (socket.error, ConnectionError):
-            print("Server not available, skipping integration test")
-            self.skipTest("Server not available")
+        self._live_messengers()
+        logger.debug("Testing connection...")
+        result = self.messenger1.connect()
+        if not result:
+            logger.debug("Connection failed for %s", self.test_user1['username'])
+        self.assertTrue(result)
+        self.assertIsNotNone(self.messenger1.token)
 
     def test_send_message(self):
         """Test sending a message"""
-        try:
-            print("\nTesting message sending...")
-            # firstly, connect both users
-            print("Connecting user2...")
-            self.assertTrue(self.messenger2.connect())
-            print("Connecting user1...")
-            self.assertTrue(self.messenger1.connect())
-
-            # send a message from user1 to user2
-            message = "Hello, this is a test message!"
-            print(f"Sending message: {message}")
-            success = self.messenger1.send(message, self.test_user2['username'])
-            self.assertTrue(success)
-        except (socket.error, ConnectionError):
-            print("Server not available, skipping integration test")
-            self.skipTest("Server not available")
+        self._live_messengers()
+        logger.debug("Testing message sending...")
+        # firstly, connect both users
+        logger.debug("Connecting user2...")
+        self.assertTrue(self.messenger2.connect())
+        logger.debug("Connecting user1...")
+        self.assertTrue(self.messenger1.connect())
+
+        # send a message from user1 to user2
+        message = "Hello, this is a test message!"
+        logger.debug("Sending message: %s", message)
+        success = self.messenger1.send(message, self.test_user2['username'])
+        self.assertTrue(success)
 
     def test_retrieve_new_messages(self):
         """Test retrieving new messages"""
-        try:
-            print("\nTesting new message retrieval...")
-            # first connect both users
-            print("Connecting users...")
-            self.assertTrue(self.messenger2.connect())
-            self.assertTrue(self.messenger1.connect())
-
-            # send a message from user1 to user2
-            message = "Test message for new messages"
-            print(f"Sending message: {message}")
-            self.messenger1.send(message, self.test_user2['username'])
-
-            # wait briefly for message to be processed
-            time.sleep(1)
-
-            # retrieve the new messages for user2
-            print("Retrieving new messages...")
-            messages = self.messenger2.retrieve_new()
-            self.assertGreater(len(messages), 0)
-            self.assertEqual(messages[0].message, message)
-        except (socket.error, ConnectionError):
-            print("Server not available, skipping integration test")
-            self.skipTest("Server not available")
+        self._live_messengers()
+        logger.debug("Testing new message retrieval...")
+        # first connect both users
+        logger.debug("Connecting users...")
+        self.assertTrue(self.messenger2.connect())
+        self.assertTrue(self.messenger1.connect())
+
+        # send a message from user1 to user2
+        message = "Test message for new messages"
+        logger.debug("Sending message: %s", message)
+        self.messenger1.send(message, self.test_user2['username'])
+
+        # retrieve the new messages for user2, once the server has them
+        logger.debug("Retrieving new messages...")
+        messages = _wait_for_message(self.messenger2.retrieve_new,
+                                     message)
+        self.assertGreater(len(messages), 0)
+        self.assertEqual(messages[0].message, message)
 
     def test_retrieve_all_messages(self):
         """Test retrieving all messages"""
-        try:
-            print("\nTesting all messages retrieval...")
-            # first connect both users
-            print("Connecting users...")
-            self.assertTrue(self.messenger2.connect())
-            self.assertTrue(self.messenger1.connect())
-
-            # send a message from user1 to user2
-            message = "Test message for all messages"
-            print(f"Sending message: {message}")
-            self.messenger1.send(message, self.test_user2['username'])
-
-            # wait briefly for message to be processed
-            time.sleep(1)
-
-            # retrieve all messages for both users
-            print("Retrieving all messages...")
-            messages1 = self.messenger1.retrieve_all()
-            messages2 = self.messenger2.retrieve_all()
-
-            self.assertGreater(len(messages1), 0)
-            self.assertGreater(len(messages2), 0)
-        except (socket.error, ConnectionError):
-            print("Server not available, skipping integration test")
-            self.skipTest("Server not available")
-
-    def tearDown(self):
-        """Cleaning up after each test"""
-        if hasattr(self, 'messenger1') and self.messenger1:
-            self.messenger1.close()
-        if hasattr(self, 'messenger2') and self.messenger2:
-            self.messenger2.close()
+        self._live_messengers()
+        logger.debug("Testing all messages retrieval...")
+        # first connect both users
+        logger.debug("Connecting users...")
+        self.assertTrue(self.messenger2.connect())
+        self.assertTrue(self.messenger1.connect())
+
+        # send a message from user1 to user2
+        message = "Test message for all messages"
+        logger.debug("Sending message: %s", message)
+        self.messenger1.send(message, self.test_user2['username'])
+
+        # retrieve all messages for both users, once the server has them
+        logger.debug("Retrieving all messages...")
+        messages2 = _wait_for_message(self.messenger2.retrieve_all,
+                                      message)
+        messages1 = self.messenger1.retrieve_all()
+
+        self.assertGreater(len(messages1), 0)
+        self.assertGreater(len(messages2), 0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,51 @@
+# testsupport.py
+"""Shared setup for the test modules: the test server and test accounts."""
+
+import functools
+import logging
+import os
+import socket
+import time
+import unittest
+
+logger = logging.getLogger(__name__)
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 3001
+
+# the test accounts, made once at import: the timestamp keeps them unique
+# for each test run and the pid keeps parallel test workers from sharing
+# accounts on the server
+RUN_ID = f'{int(time.time())}_{os.getpid()}'
+TEST_USER1 = {'username': f'testuser1_{RUN_ID}', 'password': 'testpass1'}
+TEST_USER2 = {'username': f'testuser2_{RUN_ID}', 'password': 'testpass2'}
+
+
+@functools.lru_cache(maxsize=None)
+def server_up() -> bool:
+    """check, once per process, whether anything is listening where the
+    server should be"""
+    try:
+        with socket.create_connection((SERVER_HOST, SERVER_PORT),
+                                      timeout=0.1):
+            return True
+    except OSError:
+        logger.info("Server not available, skipping the server tests")
+        return False
+
+
+def needs_server(cls):
+    """class decorator that skips a test class when the server isn't up
+
+    the server is probed when the class is set up rather than at import,
+    so a run that deselects every server test never connects, and the
+    probe is shared by all the classes in the process."""
+    set_up_class = cls.setUpClass.__func__
+
+    def setUpClass(klass):
+        if not server_up():
+            raise unittest.SkipTest("Server not available")
+        set_up_class(klass)
+
+    cls.setUpClass = classmethod(setUpClass)
+    return cls